@@ -0,0 +1,521 @@
+"""Нагрузочный тест и замер задержек API
+
+Синтетическая популяция устройств крутит цикл get-task -> complete-task ->
+get-user, параллельно админ опрашивает /admin/stats, /admin/users и
+/admin/analytics. База создается во временном каталоге и заранее
+наполняется большими таблицами users/assignments. Сеть не нужна: по
+умолчанию приложение вызывается в процессе через ASGI, с ``--uvicorn`` —
+через локальный uvicorn.
+
+    python bench.py --duration 15 --output bench.json
+    python bench.py --uvicorn --baseline bench.json --threshold 0.2
+    python bench.py --backend sqlalchemy --baseline bench.json
+
+Результат пишется в JSON; с ``--baseline`` прогон сравнивается с прошлым
+и завершается с кодом 1, если p95 или пропускная способность любого
+эндпоинта или CPU на запрос ухудшились больше чем на ``--threshold``.
+В задержки и запр/с входят только ответы 2xx; остальные — ошибки, и прогон
+с долей ошибок выше ``--max-error-rate`` тоже завершается с кодом 1. Лимиты
+частоты и сброс нагрузки в прогоне выключены (если не заданы в окружении).
+CPU на запрос в режиме ASGI включает клиентов, с ``--uvicorn`` — только
+сервер. Большие страницы админки сравнивают режимы сериализации:
+
+    FAST_SERIALIZATION=0 python bench.py --admin-page-size 1000 --admin-interval 0 --output slow.json
+    python bench.py --admin-page-size 1000 --admin-interval 0 --baseline slow.json
+
+После прогона счетчики, балансы и агрегаты сверяются с исходными строками
+(как ``maintenance.py reconcile``); любое расхождение — тоже код 1. С
+``--workers N`` несколько процессов uvicorn пишут в одну базу:
+
+    python bench.py --workers 4 --duration 20
+    python bench.py --workers 4 --shards 4 --duration 20
+
+С ``--cold-start`` нагрузки нет: ``main.py`` запускается несколько раз, и
+прогон завершается с кодом 1, если медиана времени до первого ответа
+больше ``--startup-budget-ms``:
+
+    python bench.py --cold-start --seed-users 1000 --seed-assignments 10000
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+KEYWORDS = ["technology", "programming", "science", "news", "education"]
+
+# Схемы DATABASE_URL бэкендов (см. storage.open_database)
+BACKEND_URLS = {
+    'sqlite': 'sqlite:///{path}',
+    'sqlalchemy': 'sqlite+pysqlite:///{path}',
+}
+
+
+def shard_paths(path: str, shards: int) -> list:
+    sys.path.insert(0, ROOT)
+    from sharding import shard_urls
+    return [url.split(':///', 1)[1] for url in shard_urls(f'sqlite:///{path}', shards)]
+
+
+def seed_database(path: str, users: int, assignments: int, seed: int = 0, shards: int = 1):
+    """Создает схему и наполняет базу согласованными данными (счетчики и журнал).
+
+    С ``shards > 1`` пользователи раскладываются по файлам шардов так же,
+    как это делает приложение, назначения — пропорционально.
+    """
+    sys.path.insert(0, ROOT)
+    from sharding import shard_index
+
+    rnd = random.Random(seed)
+    device_ids = [[] for _ in range(shards)]
+    for i in range(users):
+        device_id = f'seed-{i}'
+        device_ids[shard_index(device_id, shards)].append(device_id)
+    for shard_path, devices in zip(shard_paths(path, shards), device_ids):
+        _seed_shard(shard_path, devices, assignments * len(devices) // max(users, 1), rnd)
+
+
+def _seed_shard(path: str, device_ids: list, assignments: int, rnd: random.Random):
+    from migrations import migrate
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrate(conn)
+    if not device_ids:
+        conn.close()
+        return
+
+    task_ids = [row[0] for row in conn.execute('SELECT id FROM tasks WHERE is_active = 1')]
+    conn.executemany(
+        "INSERT INTO users (device_id, ip_address, last_seen) "
+        "VALUES (?, '10.0.0.1', datetime('now', ?))",
+        [(device_id, f'-{rnd.randint(0, 72 * 3600)} seconds') for device_id in device_ids]
+    )
+
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    counters = defaultdict(lambda: {'completed': 0, 'expired': 0, 'assigned': 0, 'reward': 0.0, 'traffic': 0.0})
+    rows, ledger = [], []
+    for assignment_id in range(1, assignments + 1):
+        user_id = rnd.choice(user_ids)
+        status = rnd.choices(['completed', 'expired', 'assigned'], weights=[85, 10, 5])[0]
+        reward = round(rnd.uniform(0.05, 0.2), 2)
+        traffic = 10.0 if status == 'completed' else 0.0
+        keyword = rnd.choice(KEYWORDS)
+        age = rnd.randint(300, 6 * 24 * 3600)
+        rows.append((assignment_id, user_id, rnd.choice(task_ids), f'https://example.com/?q={keyword}',
+                     'Поиск', 'Описание', 300, 900, reward, traffic, status, f'-{age} seconds',
+                     f'-{age - 300} seconds' if status == 'completed' else None,
+                     f'-{age - 1200} seconds'))
+        counter = counters[user_id]
+        counter[status] += 1
+        if status == 'completed':
+            counter['reward'] += reward
+            counter['traffic'] += traffic
+            ledger.append((user_id, assignment_id, reward, traffic))
+
+    conn.executemany('''
+        INSERT INTO assignments (id, user_id, task_id, assigned_url, assigned_title, assigned_description,
+                                 visit_duration_sec, wait_duration_sec, reward, traffic_used_mb, status,
+                                 assigned_at, completed_at, due_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now', ?), datetime('now', ?),
+                datetime('now', ?))
+    ''', rows)
+    conn.executemany(
+        "INSERT INTO ledger (user_id, assignment_id, kind, reward, traffic_mb) VALUES (?, ?, 'reward', ?, ?)",
+        ledger
+    )
+    conn.executemany('''
+        UPDATE users SET total_completed = ?, total_expired = ?, active_assignments = ?,
+                         balance = ?, total_traffic_mb = ?
+        WHERE id = ?
+    ''', [(c['completed'], c['expired'], c['assigned'], c['reward'], c['traffic'], user_id)
+          for user_id, c in counters.items()])
+    conn.commit()
+    conn.close()
+
+
+class Recorder:
+    """Задержки запросов по эндпоинтам.
+
+    В задержки и пропускную способность идут только ответы 2xx; остальные
+    ответы и сетевые ошибки — ошибки, а 429 и 503 (лимиты и сброс
+    нагрузки) еще и считаются отдельно как отказы.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    async def call(self, name: str, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            return None
+        if response.is_success:
+            self.latencies[name].append(time.perf_counter() - started)
+        else:
+            self.errors[name] += 1
+            if response.status_code in (429, 503):
+                self.rejected[name] += 1
+        return response
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder: Recorder, elapsed: float) -> dict:
+    endpoints = {}
+    for name in sorted(set(recorder.latencies) | set(recorder.errors)):
+        values = sorted(recorder.latencies[name])
+        errors = recorder.errors[name]
+        endpoints[name] = {
+            'requests': len(values),
+            'errors': errors,
+            'rejected': recorder.rejected[name],
+            'error_rate': round(errors / (len(values) + errors), 4) if errors else 0.0,
+            'throughput_rps': round(len(values) / elapsed, 2),
+            'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        }
+    total = sum(e['requests'] for e in endpoints.values())
+    errors = sum(e['errors'] for e in endpoints.values())
+    return {
+        'elapsed_sec': round(elapsed, 3),
+        'total_requests': total,
+        'total_errors': errors,
+        'error_rate': round(errors / (total + errors), 4) if errors else 0.0,
+        'total_throughput_rps': round(total / elapsed, 2),
+        'endpoints': endpoints,
+    }
+
+
+async def device_worker(client, recorder: Recorder, devices: asyncio.Queue, deadline: float):
+    """Один клиент: берет свободное устройство и проходит полный цикл.
+
+    Устройство в цикле занято: как и настоящее, оно не завершает одно
+    назначение из двух клиентов сразу (в другом воркере это был бы 400).
+    """
+    while time.monotonic() < deadline:
+        device_id = await devices.get()
+        try:
+            response = await recorder.call('GET /get-task/{device_id}',
+                                           client.get(f'/get-task/{device_id}'))
+            if response is None or response.status_code != 200:
+                continue
+            assignment_id = response.json()['assignment_id']
+            await recorder.call('POST /complete-task', client.post('/complete-task', json={
+                'device_id': device_id, 'assignment_id': assignment_id, 'traffic_used_mb': 5.0,
+            }))
+            await recorder.call('GET /user/{device_id}', client.get(f'/user/{device_id}'))
+        finally:
+            devices.put_nowait(device_id)
+
+
+async def admin_worker(client, recorder: Recorder, deadline: float, interval: float, page_size: int):
+    while time.monotonic() < deadline:
+        await recorder.call('GET /admin/stats', client.get('/admin/stats'))
+        await recorder.call('GET /admin/users', client.get('/admin/users', params={'limit': page_size}))
+        await recorder.call('GET /admin/analytics', client.get('/admin/analytics', params={'group_by': 'task'}))
+        await asyncio.sleep(interval)
+
+
+async def drive(client, args) -> dict:
+    devices = [f'bench-{i}' for i in range(args.devices)]
+    recorder = Recorder()
+
+    # Прогрев: создаем пользователей и кэши до начала замера
+    for device_id in devices[:args.concurrency]:
+        await client.get(f'/user/{device_id}')
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    free = asyncio.Queue()
+    for device_id in random.sample(devices, len(devices)):
+        free.put_nowait(device_id)
+    workers = [device_worker(client, recorder, free, deadline) for _ in range(args.concurrency)]
+    workers += [admin_worker(client, recorder, deadline, args.admin_interval, args.admin_page_size)
+                for _ in range(args.admin_workers)]
+    await asyncio.gather(*workers)
+    return summarize(recorder, time.monotonic() - started)
+
+
+async def run_in_process(args) -> dict:
+    sys.path.insert(0, ROOT)
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            # CPU процесса: здесь в нем же работают и клиенты
+            started = time.process_time()
+            result = await drive(client, args)
+            result['cpu_sec'] = time.process_time() - started
+            return result
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def run_uvicorn(args, env: dict) -> dict:
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(args.workers), '--log-level', 'warning'],
+        cwd=ROOT, env=env,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    limits = httpx.Limits(max_connections=args.concurrency + args.admin_workers)
+    times = os.times()
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            for _ in range(200):
+                try:
+                    await client.get('/')
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.05)
+            else:
+                raise RuntimeError('uvicorn не запустился')
+            result = await drive(client, args)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    # CPU сервера (вместе с запуском) известен после завершения дочернего процесса
+    result['cpu_sec'] = (os.times().children_user - times.children_user
+                         + os.times().children_system - times.children_system)
+    return result
+
+
+def cold_start(args, env: dict) -> dict:
+    """Время до первого ответа: ``python main.py`` как на Render, сразу /get-task.
+
+    Клиент стучится без пауз с момента запуска процесса, поэтому в замер
+    входят интерпретатор, импорты, инициализация базы и сам запрос.
+    """
+    timings, profile = [], ''
+    for _ in range(args.cold_start_runs):
+        port = _free_port()
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, 'main.py', '--host', '127.0.0.1', '--port', str(port)],
+            cwd=ROOT, env=dict(env, STARTUP_PROFILE='1'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        try:
+            with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=30) as client:
+                while True:
+                    try:
+                        client.get('/get-task/cold-start').raise_for_status()
+                        break
+                    except httpx.TransportError:
+                        if server.poll() is not None:
+                            raise RuntimeError('main.py завершился при старте')
+                        time.sleep(0.005)
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            server.terminate()
+            _, stderr = server.communicate(timeout=30)
+        # Отчет профилировщика (startup.py) последнего запуска
+        lines = stderr.splitlines()
+        if 'Старт приложения:' in lines:
+            lines = lines[lines.index('Старт приложения:'):]
+            profile = '\n'.join(lines[:next(i for i, line in enumerate(lines) if line.startswith('всего')) + 1])
+
+    timings.sort()
+    return {
+        'time_to_first_response_ms': {
+            'min': round(timings[0], 1),
+            'median': round(timings[len(timings) // 2], 1),
+            'max': round(timings[-1], 1),
+        },
+        'budget_ms': args.startup_budget_ms,
+        'profile': profile,
+    }
+
+
+def check_consistency(path: str) -> list:
+    """Сверяет денормализованные данные с исходными строками, ничего не исправляя"""
+    sys.path.insert(0, ROOT)
+    from maintenance import reconcile_counters, reconcile_balances, reconcile_stats, reconcile_rollups
+
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        problems = [f'{device_id}: {column} = {stored}, по строкам {actual}'
+                    for device_id, column, stored, actual
+                    in reconcile_counters(conn) + reconcile_balances(conn)]
+        problems += [f'stats.{key} = {stored}, по таблицам {actual}'
+                     for key, stored, actual in reconcile_stats(conn)]
+        problems += [f'{table}[{bucket}, {task_id}] = {stored}, по строкам {actual}'
+                     for table, bucket, task_id, stored, actual in reconcile_rollups(conn)]
+    finally:
+        conn.close()
+    return problems
+
+
+def check_shards(path: str, shards: int) -> list:
+    """``check_consistency`` каждого шарда и проверка, что устройства лежат в своих шардах"""
+    from sharding import shard_index
+
+    problems = []
+    for index, shard_path in enumerate(shard_paths(path, shards)):
+        problems += [f'шард {index}: {line}' for line in check_consistency(shard_path)]
+        conn = sqlite3.connect(shard_path)
+        misplaced = [device_id for (device_id,) in conn.execute('SELECT device_id FROM users')
+                     if shard_index(device_id, shards) != index]
+        conn.close()
+        problems += [f'шард {index}: чужое устройство {device_id}' for device_id in misplaced]
+    return problems
+
+
+def compare(baseline: dict, result: dict, threshold: float) -> list:
+    """Возвращает список регрессий относительно прошлого прогона"""
+    regressions = []
+    for name, current in result['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {current['p95_ms']} мс")
+        if previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] * (1 - threshold):
+            regressions.append(f"{name}: {previous['throughput_rps']} -> {current['throughput_rps']} запр/с")
+    previous_cpu = baseline.get('cpu_ms_per_request')
+    if previous_cpu and result['cpu_ms_per_request'] > previous_cpu * (1 + threshold):
+        regressions.append(f"CPU {previous_cpu} -> {result['cpu_ms_per_request']} мс/запр")
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"{'эндпоинт':32} {'запр':>7} {'ошибки':>7} {'отказы':>7} {'запр/с':>9} "
+          f"{'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, e in result['endpoints'].items():
+        print(f"{name:32} {e['requests']:>7} {e['errors']:>7} {e['rejected']:>7} {e['throughput_rps']:>9} "
+              f"{e['p50_ms']:>8} {e['p95_ms']:>8} {e['p99_ms']:>8}")
+    print(f"Всего: {result['total_requests']} успешных запросов, {result['total_throughput_rps']} запр/с, "
+          f"ошибок {result['error_rate']:.2%}, CPU {result['cpu_ms_per_request']} мс/запр")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест API')
+    parser.add_argument('--devices', type=int, default=2000, help='Размер популяции устройств')
+    parser.add_argument('--concurrency', type=int, default=64, help='Одновременных клиентов')
+    parser.add_argument('--duration', type=float, default=15, help='Длительность замера, секунд')
+    parser.add_argument('--admin-workers', type=int, default=1)
+    parser.add_argument('--admin-interval', type=float, default=0.5, help='Пауза между опросами админки')
+    parser.add_argument('--admin-page-size', type=int, default=100, help='limit для /admin/users')
+    parser.add_argument('--seed-users', type=int, default=20000, help='Пользователей в базе до старта')
+    parser.add_argument('--seed-assignments', type=int, default=200000, help='Назначений в базе до старта')
+    parser.add_argument('--uvicorn', action='store_true', help='Запустить локальный uvicorn вместо ASGI')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Процессов uvicorn на одну базу (больше 1 — включает --uvicorn)')
+    parser.add_argument('--shards', type=int, default=1, help='Файлов-шардов (DB_SHARDS)')
+    parser.add_argument('--backend', choices=sorted(BACKEND_URLS), default='sqlite',
+                        help='Бэкенд хранилища (DATABASE_URL)')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='Вместо нагрузки замерить время до первого ответа после запуска')
+    parser.add_argument('--cold-start-runs', type=int, default=5)
+    parser.add_argument('--startup-budget-ms', type=float, default=3000,
+                        help='Допустимая медиана времени до первого ответа')
+    parser.add_argument('--output', default='bench.json', help='Куда записать результат')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Допустимое ухудшение (доля)')
+    parser.add_argument('--max-error-rate', type=float, default=0.01,
+                        help='Допустимая доля ошибок (не 2xx и сетевых) среди всех запросов')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.workers > 1:
+        args.uvicorn = True
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    db_path = os.path.join(workdir, 'tasks.db')
+    seed_database(db_path, args.seed_users, args.seed_assignments, shards=args.shards)
+
+    env = dict(os.environ, TASKS_DB_PATH=db_path, DB_SHARDS=str(args.shards),
+               DATABASE_URL=BACKEND_URLS[args.backend].format(path=db_path),
+               # Все клиенты бенчмарка приходят с одного адреса, а устройства
+               # повторяют цикл без пауз: лимиты и сброс нагрузки меряли бы
+               # отказы, а не обработку запросов
+               RATE_LIMIT_IP_RPS=os.environ.get('RATE_LIMIT_IP_RPS', '0'),
+               RATE_LIMIT_DEVICE_RPS=os.environ.get('RATE_LIMIT_DEVICE_RPS', '0'),
+               SHED_MAX_PENDING_WRITES=os.environ.get('SHED_MAX_PENDING_WRITES', '0'),
+               SHED_MAX_LOOP_LAG_MS=os.environ.get('SHED_MAX_LOOP_LAG_MS', '0'),
+               WEB_CONCURRENCY=str(args.workers),
+               # Один процесс: кэш ответов как у `python main.py` (см. config.py)
+               RESPONSE_CACHE_SIZE=os.environ.get('RESPONSE_CACHE_SIZE',
+                                                  '10000' if args.workers == 1 else '0'))
+    os.environ.update(env)
+    if args.cold_start:
+        result = cold_start(args, env)
+        ttfr = result['time_to_first_response_ms']
+        print(result['profile'])
+        print(f"До первого ответа: медиана {ttfr['median']} мс (мин {ttfr['min']}, макс {ttfr['max']}), "
+              f"бюджет {args.startup_budget_ms} мс")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        return 1 if ttfr['median'] > args.startup_budget_ms else 0
+
+    if args.uvicorn:
+        result = asyncio.run(run_uvicorn(args, env))
+    else:
+        result = asyncio.run(run_in_process(args))
+
+    attempts = result['total_requests'] + result['total_errors']
+    result['cpu_ms_per_request'] = round(result.pop('cpu_sec') * 1000 / max(1, attempts), 3)
+    result['meta'] = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'mode': 'uvicorn' if args.uvicorn else 'asgi',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+    }
+    result['consistency'] = check_shards(db_path, args.shards)
+    print_report(result)
+    for line in result['consistency']:
+        print(f'Расхождение: {line}')
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    if result['consistency']:
+        return 1
+    if result['error_rate'] > args.max_error_rate:
+        print(f"Доля ошибок {result['error_rate']:.2%} больше {args.max_error_rate:.2%}")
+        return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), result, args.threshold)
+        for line in regressions:
+            print(f'Регрессия: {line}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
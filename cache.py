@@ -0,0 +1,134 @@
+"""Ограниченные кэши в памяти процесса: LRU с TTL, идемпотентные вызовы
+и ответы с версиями для условных GET"""
+import asyncio
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """LRU не больше ``capacity`` записей, каждая живет ``ttl`` секунд.
+
+    Используется только из event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, capacity: int = 100_000, ttl: float = 600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._items: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def pop(self, key):
+        self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class IdempotencyCache:
+    """Повтор запроса с тем же ключом получает результат первого.
+
+    Операция выполняется отдельной задачей, а запросы ждут ее через
+    ``asyncio.shield``: отмена запроса (клиент закрыл соединение) не
+    прерывает запись, и результат все равно попадает в кэш. Пока задача
+    выполняется, повторы ждут ее результата (или ту же ошибку), а не
+    выполняют операцию второй раз. Успешные результаты хранятся в
+    ``TTLCache``; ошибки не кэшируются.
+    """
+
+    def __init__(self, capacity: int = 100_000, ttl: float = 600):
+        self.results = TTLCache(capacity, ttl)
+        self._inflight = {}
+
+    async def run(self, key, call: Callable[[], Awaitable]) -> Tuple[Any, str]:
+        """Возвращает ``(результат, 'hit' | 'inflight' | 'miss')``"""
+        cached = self.results.get(key)
+        if cached is not None:
+            return cached, "hit"
+
+        task = self._inflight.get(key)
+        if task is not None:
+            return await asyncio.shield(task), "inflight"
+
+        task = asyncio.ensure_future(call())
+        self._inflight[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), "miss"
+
+    def _finish(self, key, task: asyncio.Future):
+        del self._inflight[key]
+        if task.cancelled():
+            return
+        # Ошибку получат ожидающие запросы; без них не пишем предупреждение
+        if task.exception() is None:
+            self.results.set(key, task.result())
+
+
+class VersionedCache:
+    """Значения по ключу вместе с версией данных ключа.
+
+    Пути записи вызывают ``bump(key)`` после коммита: версия ключа берется
+    из общего растущего счетчика, а закэшированное значение удаляется.
+    Чтение запоминает ``version(key)`` до запроса к БД; ``set`` не сохраняет
+    результат, если за это время ключ изменился. Версии тоже хранятся в
+    ограниченном LRU: ключ без записи получает наибольшую вытесненную версию,
+    поэтому версия ключа никогда не повторяется для других данных.
+
+    ETag из ``etag(версия, ...)`` содержит метку процесса: после перезапуска
+    старые ETag не совпадут. С ``capacity=0`` кэш выключен.
+    """
+
+    def __init__(self, capacity: int = 10_000, ttl: float = 60):
+        self.capacity = capacity
+        self.entries = TTLCache(capacity, ttl)
+        self._versions: 'OrderedDict[Hashable, int]' = OrderedDict()
+        self._counter = itertools.count(1)
+        self._floor = 0
+        self._epoch = uuid.uuid4().hex[:8]
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def version(self, key) -> int:
+        return self._versions.get(key, self._floor)
+
+    def bump(self, key):
+        if not self.enabled:
+            return
+        self._versions[key] = next(self._counter)
+        self._versions.move_to_end(key)
+        while len(self._versions) > 4 * self.capacity:
+            _, version = self._versions.popitem(last=False)
+            self._floor = max(self._floor, version)
+        self.entries.pop(key)
+
+    def get(self, key) -> Optional[Tuple[int, Any]]:
+        """``(версия, значение)`` или None"""
+        return self.entries.get(key)
+
+    def set(self, key, version: int, value):
+        if self.enabled and self.version(key) == version:
+            self.entries.set(key, (version, value))
+
+    def etag(self, version: int, *parts) -> str:
+        """Слабый ETag: представление равнозначно, пока не изменилась версия"""
+        return 'W/"%s"' % "-".join(map(str, (self._epoch, version, *parts)))
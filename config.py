@@ -4,9 +4,77 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Настройки базы данных
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+# sqlite:///путь — встроенный SQLite-бэкенд (пул чтения и единственный писатель);
+# sqlite+pysqlite:///путь — тот же SQLite через пул соединений SQLAlchemy
+# (см. storage.open_database). Другие СУБД не поддерживаются: если в окружении
+# уже есть DATABASE_URL другой базы (например, postgres:// от Render), приложение
+# не стартует — уберите переменную или укажите SQLite
+DB_PATH = os.getenv("TASKS_DB_PATH", "tasks.db")
+DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{DB_PATH}")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 4))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))
+DB_COMMIT_WINDOW_MS = float(os.getenv("DB_COMMIT_WINDOW_MS", 2))
+# Число файлов-шардов данных пользователей; фиксируется при развертывании
+DB_SHARDS = int(os.getenv("DB_SHARDS", 1))
 
 # Настройки приложения
 CHECK_INTERVAL = 30 * 60  # 30 минут в секундах
 DEFAULT_REWARD = 0.10     # Награда по умолчанию
 DEFAULT_DURATION = 30     # Длительность посещения по умолчанию (сек)
+TASK_WEIGHT_BY_REWARD = os.getenv("TASK_WEIGHT_BY_REWARD", "0") == "1"
+COMPLETED_CACHE_SIZE = int(os.getenv("COMPLETED_CACHE_SIZE", 100_000))
+# Как часто сверять версию шаблонов с БД (изменения других воркеров), секунд
+TEMPLATE_REVALIDATE_SEC = float(os.getenv("TEMPLATE_REVALIDATE_SEC", 1.0))
+MAX_TASK_BATCH = int(os.getenv("MAX_TASK_BATCH", 10))
+MAX_COMPLETION_BATCH = int(os.getenv("MAX_COMPLETION_BATCH", 50))
+ADMIN_USERS_PAGE_SIZE = int(os.getenv("ADMIN_USERS_PAGE_SIZE", 100))
+ADMIN_USERS_MAX_PAGE = int(os.getenv("ADMIN_USERS_MAX_PAGE", 1000))
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 1000))
+SSE_KEEPALIVE_SEC = float(os.getenv("SSE_KEEPALIVE_SEC", 15))
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", 16))
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", 1000))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 100_000))
+IDEMPOTENCY_TTL_SEC = float(os.getenv("IDEMPOTENCY_TTL_SEC", 600))
+# Списки отдаются словарями через orjson, без Pydantic-моделей на каждую строку
+FAST_SERIALIZATION = os.getenv("FAST_SERIALIZATION", "1") == "1"
+
+# Кэш ответов /user и /admin/stats с ETag (0 — выключен). Версии данных живут
+# в памяти процесса и не видят записей других воркеров, а сколько процессов
+# запустили `uvicorn --workers N` или gunicorn, приложению не узнать. Поэтому
+# кэш включается явно через RESPONSE_CACHE_SIZE, а без него — только в
+# `python main.py` с одним воркером. При WEB_CONCURRENCY > 1 он выключен всегда
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 0)) if WEB_CONCURRENCY == 1 else 0
+SINGLE_PROCESS_RESPONSE_CACHE_SIZE = 10_000
+RESPONSE_CACHE_TTL_SEC = float(os.getenv("RESPONSE_CACHE_TTL_SEC", 60))
+
+# Ограничение частоты запросов (0 — без ограничения) и сброс нагрузки
+RATE_LIMIT_DEVICE_RPS = float(os.getenv("RATE_LIMIT_DEVICE_RPS", 5))
+RATE_LIMIT_DEVICE_BURST = float(os.getenv("RATE_LIMIT_DEVICE_BURST", 20))
+RATE_LIMIT_IP_RPS = float(os.getenv("RATE_LIMIT_IP_RPS", 100))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", 200))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100_000))
+# Сколько прокси перед приложением дописывают адрес в X-Forwarded-For
+# (Render — один); 0 — IP клиента берется из адреса соединения
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))
+SHED_MAX_PENDING_WRITES = int(os.getenv("SHED_MAX_PENDING_WRITES", 1000))
+SHED_MAX_LOOP_LAG_MS = float(os.getenv("SHED_MAX_LOOP_LAG_MS", 500))
+
+# Старт: отчет о фазах в stderr после первого ответа; фоновые задачи
+# запускаются после первого ответа, но не позже чем через JOBS_START_DELAY_SEC
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "0") == "1"
+JOBS_START_DELAY_SEC = float(os.getenv("JOBS_START_DELAY_SEC", 30))
+
+# Фоновые задачи
+LEDGER_COMPACT_AFTER_DAYS = float(os.getenv("LEDGER_COMPACT_AFTER_DAYS", 30))
+LEDGER_COMPACT_INTERVAL = float(os.getenv("LEDGER_COMPACT_INTERVAL", 3600))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", 5))
+ASSIGNMENT_GRACE_SEC = float(os.getenv("ASSIGNMENT_GRACE_SEC", 600))
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 7))
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", 60))
+SWEEP_BATCH = int(os.getenv("SWEEP_BATCH", 1000))
+
+# Метрики
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", 0.1))
@@ -0,0 +1,133 @@
+"""Push-уведомления устройствам (SSE) и таймеры на одной куче
+
+Вместо опроса ``/get-task`` по таймеру устройство держит один поток
+``/events/{device_id}``: сервер присылает задание, когда истекло ожидание,
+и баланс после завершения. Подписки и таймеры живут в памяти процесса.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import time
+from typing import Dict, Set
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event: str, data) -> str:
+    """Сообщение в формате text/event-stream"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class EventHub:
+    """Очереди сообщений открытых потоков по device_id.
+
+    У каждого потока небольшая очередь; если клиент не успевает читать,
+    старые сообщения вытесняются новыми (важно последнее состояние).
+    """
+
+    def __init__(self, queue_size: int = 16):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, device_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(device_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, device_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(device_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[device_id]
+
+    def is_subscribed(self, device_id: str) -> bool:
+        return device_id in self._subscribers
+
+    def publish(self, device_id: str, event: str, data):
+        message = format_event(event, data)
+        for queue in self._subscribers.get(device_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    def __len__(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+class TimerQueue:
+    """Отложенные вызовы по ключу: одна куча и одна задача asyncio на процесс.
+
+    Таймер через ``asyncio.sleep`` на каждое соединение держал бы по задаче
+    на устройство; здесь ожидание одно — до ближайшего срока. Повторный
+    ``schedule`` с тем же ключом заменяет таймер; отмененные записи остаются
+    в куче и пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()
+
+    def schedule(self, key, delay: float, callback):
+        """Через ``delay`` секунд вызывает корутинную функцию ``callback()``"""
+        self.cancel(key)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Отмененных записей больше, чем живых: пересобираем кучу
+            self._heap = [entry for entry in self._heap if entry[3] is not None]
+            heapq.heapify(self._heap)
+        entry = [time.monotonic() + delay, next(self._counter), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._wakeup is not None and self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="timers")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, *self._running, return_exceptions=True)
+        self._task = None
+
+    async def _fire(self, key, callback):
+        try:
+            await callback()
+        except Exception:
+            logger.exception("Таймер %s завершился с ошибкой", key)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and (self._heap[0][3] is None or self._heap[0][0] <= now):
+                _due, _, key, callback = heapq.heappop(self._heap)
+                if callback is None:
+                    continue
+                del self._entries[key]
+                task = asyncio.create_task(self._fire(key, callback))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
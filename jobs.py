@@ -0,0 +1,40 @@
+"""Периодические фоновые задачи, запускаемые из lifespan приложения"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJobs:
+    """Набор корутин, каждая из которых вызывается раз в ``interval`` секунд.
+
+    Ошибка одной итерации пишется в лог и не останавливает задачу.
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._tasks = []
+
+    def add(self, name: str, interval: float, job):
+        """Регистрирует корутинную функцию ``job()``"""
+        self._jobs.append((name, interval, job))
+
+    async def _run(self, name: str, interval: float, job):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Фоновая задача %s завершилась с ошибкой", name)
+
+    def start(self):
+        for name, interval, job in self._jobs:
+            self._tasks.append(asyncio.create_task(self._run(name, interval, job), name=name))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,103 +1,280 @@
-from fastapi import FastAPI, HTTPException, status, Request
+# Первым: фаза imports профиля старта считается с этой строки
+from startup import profiler
+
+from fastapi import FastAPI, HTTPException, status, Request, Response, Query, Header, Depends
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
-from datetime import datetime
-import sqlite3
+from typing import List, Literal, Optional, Union
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import random
 import json
+import math
+import time
+import zlib
+import base64
+import csv
+import io
+
+from storage import FileLock
+from sharding import Shard, ShardSet, open_shards, merge_pages, has_more
+from migrations import LATEST_VERSION, get_version, migrate
+import repository
+from repository import ADMIN_USER_COLUMNS
+from task_cache import TaskTemplate
+from jobs import PeriodicJobs
+from events import EventHub, TimerQueue, format_event
+from cache import IdempotencyCache, VersionedCache
+from serialization import FastJSONResponse, dumps
+from ratelimit import TokenBuckets, LoadShedder
+from maintenance import (compact_ledger, expire_assignments, archive_assignments,
+                         prune_activity_buckets)
+from presence import PresenceTracker, flush_presence
+import metrics
+
+from config import (
+    DATABASE_URL, DB_SHARDS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_STATEMENT_CACHE_SIZE,
+    DB_COMMIT_WINDOW_MS, TASK_WEIGHT_BY_REWARD, COMPLETED_CACHE_SIZE, TEMPLATE_REVALIDATE_SEC,
+    MAX_TASK_BATCH, MAX_COMPLETION_BATCH, ADMIN_USERS_PAGE_SIZE, ADMIN_USERS_MAX_PAGE, EXPORT_PAGE_SIZE,
+    LEDGER_COMPACT_AFTER_DAYS, LEDGER_COMPACT_INTERVAL, PRESENCE_FLUSH_INTERVAL,
+    ASSIGNMENT_GRACE_SEC, ARCHIVE_AFTER_DAYS, SWEEP_INTERVAL, SWEEP_BATCH,
+    SLOW_QUERY_MS, SLOW_QUERY_SAMPLE_RATE, SSE_KEEPALIVE_SEC, SSE_QUEUE_SIZE,
+    IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SEC,
+    RATE_LIMIT_DEVICE_RPS, RATE_LIMIT_DEVICE_BURST, RATE_LIMIT_IP_RPS, RATE_LIMIT_IP_BURST,
+    RATE_LIMIT_MAX_KEYS, TRUSTED_PROXY_HOPS, SHED_MAX_PENDING_WRITES, SHED_MAX_LOOP_LAG_MS,
+    FAST_SERIALIZATION, RESPONSE_CACHE_SIZE, SINGLE_PROCESS_RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SEC,
+    ANALYTICS_MAX_BUCKETS,
+    STARTUP_PROFILE, JOBS_START_DELAY_SEC,
+)
 
-# Конфигурация
-CHECK_INTERVAL = 30 * 60
-DEFAULT_REWARD = 0.10
-DEFAULT_DURATION = 30
+profiler.mark("imports")
 
 # Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect('tasks.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Таблица пользователей (добавляем IP и трафик)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT UNIQUE NOT NULL,
-            balance REAL DEFAULT 0.0,
-            total_traffic_mb REAL DEFAULT 0.0,
-            ip_address TEXT DEFAULT 'unknown',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE
-        )
-    ''')
-    
-    # Таблица заданий (расширяем для рандома)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            url_template TEXT NOT NULL,
-            title_template TEXT DEFAULT 'Посетить сайт',
-            description_template TEXT DEFAULT '',
-            min_duration INTEGER DEFAULT 180,  -- 3 минуты минимум
-            max_duration INTEGER DEFAULT 1440, -- 24 минуты максимум
-            min_wait INTEGER DEFAULT 900,      -- 15 минут ожидания
-            max_wait INTEGER DEFAULT 1800,    -- 30 минут ожидания  
-            base_reward REAL DEFAULT 0.10,
-            is_active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица назначений (добавляем IP и трафик)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS assignments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_id INTEGER NOT NULL,
-            assigned_url TEXT NOT NULL,
-            assigned_title TEXT NOT NULL,
-            assigned_description TEXT NOT NULL,
-            visit_duration_sec INTEGER NOT NULL,
-            wait_duration_sec INTEGER NOT NULL,
-            reward REAL NOT NULL,
-            ip_address TEXT DEFAULT 'unknown',
-            traffic_used_mb REAL DEFAULT 0.0,
-            status TEXT DEFAULT 'assigned',
-            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP NULL,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (task_id) REFERENCES tasks (id)
-        )
-    ''')
-    
-    # Добавляем шаблоны заданий, если их нет
-    cursor.execute('SELECT COUNT(*) FROM tasks')
-    if cursor.fetchone()[0] == 0:
-        task_templates = [
-            ('https://www.google.com/search?q={keyword}', 'Поиск в Google', 'Выполните поисковый запрос', 180, 900, 600, 1200, 0.08),
-            ('https://www.youtube.com/results?search_query={keyword}', 'Поиск на YouTube', 'Посмотрите видео', 300, 1440, 900, 1800, 0.15),
-            ('https://github.com/search?q={keyword}', 'Поиск на GitHub', 'Изучите репозитории', 180, 600, 600, 1200, 0.10),
-            ('https://www.amazon.com/s?k={keyword}', 'Поиск на Amazon', 'Посмотрите товары', 240, 1200, 600, 1500, 0.12),
-            ('https://twitter.com/search?q={keyword}', 'Поиск в Twitter', 'Посмотрите твиты', 180, 480, 300, 900, 0.07),
-        ]
-        
-        cursor.executemany('''
-            INSERT INTO tasks (url_template, title_template, description_template, 
-                             min_duration, max_duration, min_wait, max_wait, base_reward) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', task_templates)
-    
-    conn.commit()
-    return conn
+def init_db(conn):
+    # WAL: чтения не блокируются писателем, commit без лишних fsync
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrate(conn)
+
+def schema_current(conn) -> bool:
+    """Схема последней версии и WAL уже включен: ни блокировка, ни DDL не нужны"""
+    return (get_version(conn) >= LATEST_VERSION
+            and conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal')
+
+# Бэкенд выбирается по DATABASE_URL (см. storage.open_database), с DB_SHARDS > 1
+# данные пользователей раскладываются по нескольким файлам (см. sharding.py).
+# Шарды открываются в lifespan: у каждого воркера и каждого запуска приложения
+# свои соединения и писатели. Шаблоны заданий и выполненные пользователями
+# шаблоны кэшируются в памяти у каждого шарда
+shards: ShardSet = None
+
+def connect_shards() -> ShardSet:
+    return open_shards(DATABASE_URL, DB_SHARDS, weight_by_reward=TASK_WEIGHT_BY_REWARD,
+                       completed_cache_size=COMPLETED_CACHE_SIZE,
+                       template_revalidate_interval=TEMPLATE_REVALIDATE_SEC,
+                       pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       commit_window=DB_COMMIT_WINDOW_MS / 1000,
+                       statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                       on_connect=metrics.instrument_connection, on_commit=metrics.observe_commit)
+
+def prepare_database():
+    """Инициализация БД при старте воркера; воркеры выполняют ее по очереди"""
+    for shard in shards:
+        with shard.db.connection() as conn:
+            if not schema_current(conn):
+                with FileLock(f"{shard.db.path}.lock"):
+                    init_db(conn)
+            # Прогрев до старта писателя: первый /get-task не читает шаблоны
+            shard.template_cache.ensure(conn)
+    
+    # Шаблоны, добавленные, пока шард был недоступен, копируем из первого
+    with shards[0].db.connection() as conn:
+        tasks = repository.all_tasks(conn)
+    for shard in shards.shards[1:]:
+        with shard.db.connection() as conn:
+            repository.copy_missing_tasks(conn, tasks)
+            conn.commit()
+
+# Обслуживание (сжатие журнала, просрочка, архив) выполняет один воркер —
+# тот, кто держит блокировку; если он завершится, ее подхватит другой.
+# Файл блокировки лежит рядом с первым шардом, создается в lifespan
+maintenance_lock: FileLock = None
+
+# Журнал медленных запросов с параметрами (SLOW_QUERY_MS=0 — выключен)
+if SLOW_QUERY_MS > 0:
+    metrics.configure_slow_query_log(SLOW_QUERY_MS, SLOW_QUERY_SAMPLE_RATE)
+
+# last_seen и IP копятся в памяти и записываются пачкой
+presence = PresenceTracker()
+
+# Фоновые задачи
+jobs = PeriodicJobs()
+
+# Недавние завершения для ответа на повторы клиентов
+completions = IdempotencyCache(capacity=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL_SEC)
+
+# Ответы /user и /admin/stats по версиям данных: ключи ("user", device_id) и "stats"
+responses = VersionedCache(capacity=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SEC)
 
-# Инициализируем БД при запуске
-db_conn = init_db()
+# Открытые потоки /events и таймеры выдачи следующего задания
+hub = EventHub(queue_size=SSE_QUEUE_SIZE)
+timers = TimerQueue()
+
+# Лимиты частоты запросов и сброс нагрузки, до обращения к БД (см. ratelimit.py)
+device_limits = TokenBuckets(RATE_LIMIT_DEVICE_RPS, RATE_LIMIT_DEVICE_BURST, RATE_LIMIT_MAX_KEYS)
+ip_limits = TokenBuckets(RATE_LIMIT_IP_RPS, RATE_LIMIT_IP_BURST, RATE_LIMIT_MAX_KEYS)
+shedder = LoadShedder(max_pending_writes=SHED_MAX_PENDING_WRITES,
+                      max_loop_lag=SHED_MAX_LOOP_LAG_MS / 1000,
+                      pending_writes=lambda: shards.pending_writes())
+
+async def flush_presence_job():
+    rows = presence.drain()
+    if not rows:
+        return
+    groups = shards.group(rows, device_id=lambda row: row[2])
+    results = await asyncio.gather(*(shard.db.write(flush_presence, group)
+                                     for shard, group in groups.items()),
+                                   return_exceptions=True)
+    # Новые пользователи и активность за 24 часа меняют статистику
+    responses.bump("stats")
+    # Строки шардов, где запись не удалась, вернутся в следующий сброс
+    errors = []
+    for group, result in zip(groups.values(), results):
+        if isinstance(result, Exception):
+            presence.restore(group)
+            errors.append(result)
+    if errors:
+        raise errors[0]
+
+async def compact_ledger_job():
+    if not maintenance_lock.acquire(blocking=False):
+        return
+    # Небольшими порциями, чтобы не задерживать групповые коммиты писателя
+    for shard in shards:
+        while await shard.db.write(compact_ledger, LEDGER_COMPACT_AFTER_DAYS):
+            pass
+
+async def sweep_assignments_job():
+    if not maintenance_lock.acquire(blocking=False):
+        return
+    # Просрочка брошенных назначений, затем перенос старых строк в архив;
+    # каждая порция — отдельная операция писателя
+    for shard in shards:
+        while await shard.db.write(expire_assignments, ASSIGNMENT_GRACE_SEC, SWEEP_BATCH):
+            pass
+        while await shard.db.write(archive_assignments, ARCHIVE_AFTER_DAYS, SWEEP_BATCH):
+            pass
+        await shard.db.write(prune_activity_buckets)
+
+jobs.add("compact_ledger", LEDGER_COMPACT_INTERVAL, compact_ledger_job)
+jobs.add("sweep_assignments", SWEEP_INTERVAL, sweep_assignments_job)
+jobs.add("flush_presence", PRESENCE_FLUSH_INTERVAL, flush_presence_job)
+
+# Первый ответ после старта; до него фоновые задачи не запускаются.
+# Событие создается в lifespan, в event loop сервера
+first_response: asyncio.Event = None
+
+async def start_jobs_after_first_response():
+    """Фоновые задачи не нужны для первого ответа: запускаем их после него
+    (или через JOBS_START_DELAY_SEC, если запросов нет)"""
+    try:
+        await asyncio.wait_for(first_response.wait(), JOBS_START_DELAY_SEC)
+    except asyncio.TimeoutError:
+        pass
+    jobs.start()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global shards, maintenance_lock, first_response
+    profiler.mark("server")
+    shards = connect_shards()
+    maintenance_lock = FileLock(f"{shards[0].db.path}.jobs.lock")
+    first_response = asyncio.Event()
+    await asyncio.to_thread(prepare_database)
+    profiler.mark("prepare_database")
+    shards.start()
+    timers.start()
+    shedder.start()
+    deferred_jobs = asyncio.create_task(start_jobs_after_first_response())
+    profiler.mark("start")
+    yield
+    deferred_jobs.cancel()
+    await asyncio.gather(deferred_jobs, return_exceptions=True)
+    await shedder.stop()
+    await timers.stop()
+    await jobs.stop()
+    await flush_presence_job()
+    maintenance_lock.release()
+    shards.close()
 
 # FastAPI приложение
-app = FastAPI(title="Advanced Task Tracker API", version="2.0.0")
+# В быстром режиме ответы кодирует orjson (см. serialization.py)
+app = FastAPI(title="Advanced Task Tracker API", version="2.0.0", lifespan=lifespan,
+              default_response_class=FastJSONResponse if FAST_SERIALIZATION else JSONResponse)
+
+# Без лимитов: сбор метрик не должен пропадать под нагрузкой
+ADMISSION_EXEMPT_PATHS = ("/metrics",)
+
+def retry_after(wait: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(wait)))}
+
+class RequestMiddleware:
+    """Сброс нагрузки и лимит по IP до роутинга, длительность запросов по
+    маршрутам и отметка первого ответа; лимит устройства — в limit_device.
+
+    Чистый ASGI вместо BaseHTTPMiddleware: тот запускает обработчик в
+    отдельной задаче и передает тело ответа через очередь, а здесь статус
+    берется из сообщения ``http.response.start`` по пути в ``send``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                # Шаблон маршрута известен после роутинга; без него метки не раздуваются
+                route = scope.get("route")
+                metrics.http_request_duration.observe(
+                    time.perf_counter() - started,
+                    scope["method"], route.path if route else "unmatched", message["status"]
+                )
+                if not first_response.is_set():
+                    first_response.set()
+                    profiler.finish("first_request", started, verbose=STARTUP_PROFILE)
+            await send(message)
 
-# CORS
+        rejection = None if scope["path"] in ADMISSION_EXEMPT_PATHS else admit(scope)
+        if rejection is not None:
+            return await rejection(scope, receive, send_with_metrics)
+        await self.app(scope, receive, send_with_metrics)
+
+def admit(scope) -> Optional[Response]:
+    """Ответ с отказом или None, если запрос принят"""
+    reason = shedder.overloaded()
+    if reason:
+        metrics.rejected_requests.inc(1, reason)
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            content={"detail": "Service overloaded"}, headers=retry_after(1))
+    
+    wait = ip_limits.acquire(client_ip(scope))
+    if wait:
+        metrics.rejected_requests.inc(1, "ip")
+        return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            content={"detail": "Too many requests"}, headers=retry_after(wait))
+    return None
+
+app.add_middleware(RequestMiddleware)
+
+# CORS — добавляется последним, то есть снаружи RequestMiddleware: иначе
+# отказы 429/503 уходили бы без заголовков CORS и браузер не видел бы их
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -128,6 +305,12 @@ class CompletionResponse(BaseModel):
     total_traffic_mb: float
     next_check_seconds: int
 
+class CompletionResult(BaseModel):
+    assignment_id: int
+    status_code: int
+    result: Optional[CompletionResponse] = None
+    detail: Optional[str] = None
+
 class UserInfoResponse(BaseModel):
     device_id: str
     balance: float
@@ -148,51 +331,54 @@ class AdminUserStats(BaseModel):
     is_active: bool
 
 # Вспомогательные функции
+def client_ip(scope) -> str:
+    """IP клиента: за TRUSTED_PROXY_HOPS прокси — адрес, который дописал в
+    X-Forwarded-For ближайший к клиенту доверенный прокси, иначе адрес
+    соединения. Начало заголовка задает сам клиент, ему не доверяем"""
+    if TRUSTED_PROXY_HOPS:
+        forwarded = ",".join(value.decode("latin-1") for name, value in scope["headers"]
+                             if name == b"x-forwarded-for")
+        hops = forwarded.split(",") if forwarded else []
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
 def get_client_ip(request: Request) -> str:
     """Получаем IP адрес клиента"""
-    if request.headers.get("x-forwarded-for"):
-        return request.headers["x-forwarded-for"].split(",")[0]
-    elif request.client:
-        return request.client.host
-    return "unknown"
+    return client_ip(request.scope)
 
-def get_or_create_user(device_id: str, ip_address: str = None):
-    cursor = db_conn.cursor()
-    
-    cursor.execute('SELECT * FROM users WHERE device_id = ?', (device_id,))
-    user = cursor.fetchone()
-    
-    if not user:
-        cursor.execute(
-            'INSERT INTO users (device_id, ip_address) VALUES (?, ?)', 
-            (device_id, ip_address or 'unknown')
-        )
-        db_conn.commit()
-        cursor.execute('SELECT * FROM users WHERE device_id = ?', (device_id,))
-        user = cursor.fetchone()
-    else:
-        # Обновляем IP и время последнего визита
-        cursor.execute(
-            'UPDATE users SET ip_address = ?, last_seen = CURRENT_TIMESTAMP WHERE id = ?',
-            (ip_address or user[4], user[0])
-        )
-        db_conn.commit()
-    
-    return user
+def not_modified(request: Request, response: Response, endpoint: str, etag: str, cached: bool) -> bool:
+    """Ставит ETag и проверяет If-None-Match (слабое сравнение)"""
+    response.headers["ETag"] = etag
+    header = request.headers.get("if-none-match", "")
+    matched = header.strip() == "*" or any(
+        tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in header.split(","))
+    metrics.response_cache_requests.inc(1, endpoint,
+                                        "not_modified" if matched else "hit" if cached else "miss")
+    return matched
+
+async def limit_device(device_id: str):
+    """Лимит запросов устройства; async, чтобы бакеты трогал только event loop"""
+    wait = device_limits.acquire(device_id)
+    if wait:
+        metrics.rejected_requests.inc(1, "device")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests", headers=retry_after(wait))
 
-def generate_random_task(task_template):
+def generate_random_task(task_template: TaskTemplate):
     """Генерирует случайное задание на основе шаблона"""
     keywords = ["technology", "programming", "science", "news", "education", 
                 "sports", "music", "movies", "games", "travel", "food", "health"]
     
     keyword = random.choice(keywords)
-    url = task_template[1].replace('{keyword}', keyword)  # url_template
-    title = task_template[2].replace('{keyword}', keyword)  # title_template
-    description = task_template[3].replace('{keyword}', keyword)  # description_template
+    url = task_template.url_template.replace('{keyword}', keyword)
+    title = task_template.title_template.replace('{keyword}', keyword)
+    description = task_template.description_template.replace('{keyword}', keyword)
     
-    duration = random.randint(task_template[4], task_template[5])  # min_duration, max_duration
-    wait_time = random.randint(task_template[6], task_template[7])  # min_wait, max_wait
-    reward = task_template[8]  # base_reward
+    duration = random.randint(task_template.min_duration, task_template.max_duration)
+    wait_time = random.randint(task_template.min_wait, task_template.max_wait)
+    reward = task_template.base_reward
     
     # Немного варьируем награду
     reward_variation = random.uniform(0.8, 1.2)
@@ -212,125 +398,113 @@ def generate_random_task(task_template):
 async def root():
     return {"message": "Advanced Task Tracker API", "version": "2.0.0"}
 
-@app.get("/user/{device_id}", response_model=UserInfoResponse)
-async def get_user_info(device_id: str, request: Request):
+@app.get("/user/{device_id}", response_model=UserInfoResponse, dependencies=[Depends(limit_device)])
+async def get_user_info(device_id: str, request: Request, response: Response):
     ip_address = get_client_ip(request)
-    user = get_or_create_user(device_id, ip_address)
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
     
-    # Считаем выполненные задания
-    cursor = db_conn.cursor()
-    cursor.execute('''
-        SELECT COUNT(*) FROM assignments 
-        WHERE user_id = ? AND status = 'completed'
-    ''', (user[0],))
-    total_completed = cursor.fetchone()[0]
+    # Пока версия пользователя не менялась, строка берется из кэша без SQL
+    key = ("user", device_id)
+    cached = responses.get(key)
+    if cached:
+        version, user = cached
+    else:
+        version = responses.version(key)
+        # Чтение не превращается в запись: пишем только при создании пользователя
+        db = shards.for_device(device_id).db
+        user = await db.run(repository.find_user, device_id)
+        if not user:
+            user = await db.write(repository.upsert_user, device_id, ip_address)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        responses.set(key, version, user)
+    
+    presence.touch(device_id, ip_address)
+    ip_address, last_seen = presence.get(device_id) or (user[4], user[6])
+    
+    # last_seen — время этого же запроса, в ETag входят версия и IP
+    if responses.enabled:
+        etag = responses.etag(version, format(zlib.crc32(ip_address.encode()), "x"))
+        if not_modified(request, response, "user", etag, cached is not None):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
     
     return UserInfoResponse(
         device_id=user[1],
         balance=user[2],
-        total_completed=total_completed,
+        total_completed=user[8],
         total_traffic_mb=user[3],
-        ip_address=user[4],
+        ip_address=ip_address,
         created_at=user[5],
-        last_seen=user[6]
+        last_seen=last_seen
     )
 
-@app.get("/get-task/{device_id}", response_model=TaskAssignmentResponse)
-async def get_task(device_id: str, request: Request):
-    cursor = db_conn.cursor()
-    ip_address = get_client_ip(request)
-    
+def _assignment_response(assignment) -> TaskAssignmentResponse:
+    return TaskAssignmentResponse(
+        assignment_id=assignment[0],
+        title=assignment[4],
+        url=assignment[3],
+        description=assignment[5],
+        visit_duration_sec=assignment[6],
+        wait_duration_sec=assignment[7],
+        reward=assignment[8]
+    )
+
+def _get_task(conn, shard: Shard, device_id: str, ip_address: str, count: int = 1):
     # Находим или создаем пользователя
-    user = get_or_create_user(device_id, ip_address)
+    user = repository.get_or_create_user(conn, device_id, ip_address)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    # Проверяем активные задания
-    cursor.execute('''
-        SELECT a.* FROM assignments a 
-        WHERE a.user_id = ? AND a.status = 'assigned'
-        ORDER BY a.assigned_at DESC LIMIT 1
-    ''', (user[0],))
-    active_assignment = cursor.fetchone()
-    
-    if active_assignment:
-        return TaskAssignmentResponse(
-            assignment_id=active_assignment[0],
-            title=active_assignment[4],
-            url=active_assignment[3],
-            description=active_assignment[5],
-            visit_duration_sec=active_assignment[6],
-            wait_duration_sec=active_assignment[7],
-            reward=active_assignment[8]
-        )
-    
-    # Ищем задания, которые пользователь еще не выполнял
-    cursor.execute('''
-        SELECT t.* FROM tasks t 
-        WHERE t.is_active = 1 
-        AND t.id NOT IN (
-            SELECT task_id FROM assignments 
-            WHERE user_id = ? AND status = 'completed'
-        )
-        ORDER BY RANDOM() LIMIT 1
-    ''', (user[0],))
-    
-    task_template = cursor.fetchone()
-    
-    if not task_template:
-        # Если все задания выполнены, выбираем любое активное
-        cursor.execute('SELECT * FROM tasks WHERE is_active = 1 ORDER BY RANDOM() LIMIT 1')
-        task_template = cursor.fetchone()
+
+    # Очередь — открытые назначения с ее начала (по сроку due_at); новые
+    # встают в конец, поэтому ответ целиком упорядочен от первого к последнему
+    queue = repository.active_assignments(conn, user[0], count)
+    
+    if len(queue) < count:
+        # Выбираем шаблоны, которые пользователь еще не выполнял
+        # (если выполнены все, кэш вернет любой активный); в одной пачке
+        # по возможности не повторяемся
+        shard.template_cache.ensure(conn)
+        exclude = set(shard.completed_templates.get(conn, user[0]))
+        rows = []
+        for _ in range(count - len(queue)):
+            task_template = shard.template_cache.choose(exclude)
+            if not task_template:
+                raise HTTPException(status_code=404, detail="No tasks available")
+            exclude.add(task_template.id)
+            
+            # Генерируем случайное задание
+            task_data = generate_random_task(task_template)
+            rows.append((task_template.id, task_data['url'], task_data['title'],
+                         task_data['description'], task_data['duration'], task_data['wait_time'],
+                         task_data['reward'], ip_address))
         
-    if not task_template:
-        raise HTTPException(status_code=404, detail="No tasks available")
+        # Создаем все назначения одним INSERT; в очередь — в виде строк assignments
+        # (id, user_id, task_id, url, title, description, visit, wait, reward)
+        assignment_ids = repository.insert_assignments(conn, user[0], rows)
+        queue += [(assignment_id, user[0], *row[:7])
+                  for assignment_id, row in zip(assignment_ids, rows)]
     
-    # Генерируем случайное задание
-    task_data = generate_random_task(task_template)
-    
-    # Создаем назначение
-    cursor.execute('''
-        INSERT INTO assignments 
-        (user_id, task_id, assigned_url, assigned_title, assigned_description, 
-         visit_duration_sec, wait_duration_sec, reward, ip_address) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user[0], task_template[0], task_data['url'], task_data['title'], 
-          task_data['description'], task_data['duration'], task_data['wait_time'],
-          task_data['reward'], ip_address))
-    
-    assignment_id = cursor.lastrowid
-    db_conn.commit()
-    
-    return TaskAssignmentResponse(
-        assignment_id=assignment_id,
-        title=task_data['title'],
-        url=task_data['url'],
-        description=task_data['description'],
-        visit_duration_sec=task_data['duration'],
-        wait_duration_sec=task_data['wait_time'],
-        reward=task_data['reward']
-    )
+    return [_assignment_response(row) for row in queue]
 
-@app.post("/complete-task", response_model=CompletionResponse)
-async def complete_task(request: CompletionRequest, http_request: Request):
-    cursor = db_conn.cursor()
-    ip_address = get_client_ip(http_request)
-    
+@app.get("/get-task/{device_id}",
+         response_model=Union[TaskAssignmentResponse, List[TaskAssignmentResponse]],
+         dependencies=[Depends(limit_device)])
+async def get_task(device_id: str, request: Request,
+                   count: int = Query(1, ge=1, le=MAX_TASK_BATCH)):
+    """Выдает активное задание; с ``count > 1`` — очередь из ``count`` заданий"""
+    ip_address = get_client_ip(request)
+    presence.touch(device_id, ip_address)
+    shard = shards.for_device(device_id)
+    assignments = await shard.db.write(_get_task, shard, device_id, ip_address, count)
+    return assignments[0] if count == 1 else assignments
+
+def _complete_task(conn, shard: Shard, request: CompletionRequest, ip_address: str):
     # Находим пользователя
-    user = get_or_create_user(request.device_id, ip_address)
+    user = repository.get_or_create_user(conn, request.device_id, ip_address)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Находим назначение
-    cursor.execute('''
-        SELECT a.* FROM assignments a 
-        WHERE a.id = ? AND a.user_id = ?
-    ''', (request.assignment_id, user[0]))
-    
-    assignment = cursor.fetchone()
+    assignment = repository.get_assignment(conn, request.assignment_id, user[0])
     
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
@@ -338,29 +512,18 @@ async def complete_task(request: CompletionRequest, http_request: Request):
     if assignment[11] == 'completed':  # status
         raise HTTPException(status_code=400, detail="Task already completed")
     
-    # Обновляем статус и трафик
-    cursor.execute('''
-        UPDATE assignments SET 
-        status = 'completed', 
-        completed_at = CURRENT_TIMESTAMP,
-        traffic_used_mb = ?,
-        ip_address = ?
-        WHERE id = ?
-    ''', (request.traffic_used_mb or 10.0, ip_address, request.assignment_id))
-    
-    # Обновляем пользователя (баланс и трафик)
-    new_balance = user[2] + assignment[8]  # reward
-    total_traffic = user[3] + (request.traffic_used_mb or 10.0)
-    
-    cursor.execute('''
-        UPDATE users SET 
-        balance = ?,
-        total_traffic_mb = ?,
-        last_seen = CURRENT_TIMESTAMP
-        WHERE id = ?
-    ''', (new_balance, total_traffic, user[0]))
-    
-    db_conn.commit()
+    # Просроченное назначение не оплачивается (см. maintenance.expire_assignments)
+    if assignment[11] == 'expired':
+        raise HTTPException(status_code=410, detail="Assignment expired")
+    
+    traffic_used_mb = request.traffic_used_mb or 10.0
+    
+    credited = repository.complete_assignment(conn, assignment, user[0], traffic_used_mb, ip_address)
+    if credited is None:
+        raise HTTPException(status_code=400, detail="Task already completed")
+    new_balance, total_traffic = credited
+    
+    shard.completed_templates.add(user[0], assignment[2])  # task_id
     
     return CompletionResponse(
         status="success",
@@ -370,91 +533,416 @@ async def complete_task(request: CompletionRequest, http_request: Request):
         next_check_seconds=assignment[7]  # wait_duration_sec
     )
 
+def completion_key(request: CompletionRequest, idempotency_key: Optional[str] = None) -> tuple:
+    """Ключ повтора: заголовок Idempotency-Key или (device_id, assignment_id)"""
+    if idempotency_key:
+        return ("key", request.device_id, idempotency_key)
+    return ("assignment", request.device_id, request.assignment_id)
+
+@app.post("/complete-task", response_model=CompletionResponse)
+async def complete_task(request: CompletionRequest, http_request: Request,
+                        idempotency_key: Optional[str] = Header(None)):
+    await limit_device(request.device_id)
+    ip_address = get_client_ip(http_request)
+    presence.touch(request.device_id, ip_address)
+    shard = shards.for_device(request.device_id)
+    
+    # Повтор клиента получает ответ первого запроса без обращения к БД.
+    # complete() выполняется отдельной задачей: если клиент отключится,
+    # запись и все, что после коммита, все равно будут выполнены
+    async def complete():
+        result = await shard.db.write(_complete_task, shard, request, ip_address)
+        if idempotency_key:
+            # Повтор без заголовка (в том числе в /complete-tasks) тоже найдет ответ
+            completions.results.set(completion_key(request), (request.assignment_id, result))
+        after_completion(request.device_id, result)
+        return request.assignment_id, result
+    
+    (assignment_id, result), outcome = await completions.run(
+        completion_key(request, idempotency_key), complete)
+    metrics.idempotency_requests.inc(1, outcome)
+    if assignment_id != request.assignment_id:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was used for another assignment")
+    return result
+
+def _complete_tasks(conn, shard: Shard, requests: List[CompletionRequest], ip_address: str):
+    results = []
+    for item in requests:
+        # Ошибка одного элемента откатывает только его изменения
+        conn.execute('SAVEPOINT completion_item')
+        try:
+            result = _complete_task(conn, shard, item, ip_address)
+        except HTTPException as exc:
+            conn.execute('ROLLBACK TO completion_item')
+            results.append(CompletionResult(assignment_id=item.assignment_id,
+                                            status_code=exc.status_code, detail=exc.detail))
+        else:
+            results.append(CompletionResult(assignment_id=item.assignment_id,
+                                            status_code=200, result=result))
+        conn.execute('RELEASE completion_item')
+    return results
+
+@app.post("/complete-tasks", response_model=List[CompletionResult])
+async def complete_tasks(requests: List[CompletionRequest], http_request: Request):
+    """Применяет несколько завершений (по одной транзакции на шард), результат — для каждого элемента"""
+    if len(requests) > MAX_COMPLETION_BATCH:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_COMPLETION_BATCH} items per request")
+    
+    ip_address = get_client_ip(http_request)
+    for item in requests:
+        presence.touch(item.device_id, ip_address)
+    
+    # Лимит устройства списывается один раз на запрос; сверх лимита — 429 у его элементов
+    limited = set()
+    for device_id in {item.device_id for item in requests}:
+        try:
+            await limit_device(device_id)
+        except HTTPException:
+            limited.add(device_id)
+    
+    # Уже завершенные раньше элементы отвечаем из кэша
+    results = [None] * len(requests)
+    pending = []
+    for position, item in enumerate(requests):
+        if item.device_id in limited:
+            results[position] = CompletionResult(assignment_id=item.assignment_id,
+                                                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                                 detail="Too many requests")
+            continue
+        cached = completions.results.get(completion_key(item))
+        if cached is not None:
+            results[position] = CompletionResult(assignment_id=item.assignment_id,
+                                                 status_code=200, result=cached[1])
+        else:
+            pending.append((position, item))
+        metrics.idempotency_requests.inc(1, "miss" if cached is None else "hit")
+    
+    # Элементы разных устройств могут попасть в разные шарды; ответ — в исходном порядке
+    groups = shards.group(pending, device_id=lambda pair: pair[1].device_id)
+    
+    async def complete(shard: Shard, group: list):
+        batch = await shard.db.write(_complete_tasks, shard, [item for _, item in group], ip_address)
+        for (position, item), result in zip(group, batch):
+            results[position] = result
+            if result.result is not None:
+                completions.results.set(completion_key(item), (item.assignment_id, result.result))
+                after_completion(item.device_id, result.result)
+    
+    # Как и в /complete-task, отмена запроса не мешает сохранить результаты записи
+    await asyncio.shield(asyncio.gather(*(complete(shard, group)
+                                          for shard, group in groups.items())))
+    return results
+
+def after_completion(device_id: str, result: CompletionResponse):
+    """После коммита: новые версии пользователя и статистики, push-уведомление"""
+    responses.bump(("user", device_id))
+    responses.bump("stats")
+    notify_completion(device_id, result)
+
+# Push-уведомления: поток SSE вместо опроса по таймеру.
+# Подписки и таймеры живут в процессе; с несколькими воркерами события
+# о завершении видит поток, открытый в том же воркере
+def notify_completion(device_id: str, result: CompletionResponse):
+    """Баланс — сразу, следующее задание — когда истечет ожидание"""
+    if not hub.is_subscribed(device_id):
+        return
+    hub.publish(device_id, "balance", {"balance": result.new_balance,
+                                       "total_traffic_mb": result.total_traffic_mb,
+                                       "reward_added": result.reward_added})
+    timers.schedule(device_id, result.next_check_seconds, lambda: push_next_task(device_id))
+
+async def push_next_task(device_id: str):
+    if not hub.is_subscribed(device_id):
+        return
+    ip_address = (presence.get(device_id) or ("unknown",))[0]
+    shard = shards.for_device(device_id)
+    assignments = await shard.db.write(_get_task, shard, device_id, ip_address, 1)
+    hub.publish(device_id, "assignment", jsonable_encoder(assignments[0]))
+
+def _event_state(conn, device_id: str):
+    """Пользователь, его открытое назначение и сколько ждать следующего"""
+    user = repository.find_user(conn, device_id)
+    if not user:
+        return None, None, 0
+    active = repository.active_assignments(conn, user[0], 1)
+    delay = 0 if active else repository.next_task_delay(conn, user[0])
+    return user, active[0] if active else None, delay
+
+async def _event_stream(device_id: str, ip_address: str):
+    queue = hub.subscribe(device_id)
+    try:
+        db = shards.for_device(device_id).db
+        user, active, delay = await db.run(_event_state, device_id)
+        if not user:
+            user = await db.write(repository.upsert_user, device_id, ip_address)
+        yield format_event("balance", {"balance": user[2], "total_traffic_mb": user[3]})
+        
+        if active:
+            yield format_event("assignment", jsonable_encoder(_assignment_response(active)))
+        elif delay > 0:
+            timers.schedule(device_id, delay, lambda: push_next_task(device_id))
+        else:
+            await push_next_task(device_id)
+        
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SEC)
+            except asyncio.TimeoutError:
+                # Комментарий SSE: держит соединение через прокси
+                yield ": keepalive\n\n"
+    finally:
+        hub.unsubscribe(device_id, queue)
+        if not hub.is_subscribed(device_id):
+            timers.cancel(device_id)
+
+@app.get("/events/{device_id}", dependencies=[Depends(limit_device)])
+async def device_events(device_id: str, request: Request):
+    """Поток SSE: событие ``assignment`` с заданием, когда истекло ожидание,
+    и ``balance`` после каждого завершения"""
+    ip_address = get_client_ip(request)
+    presence.touch(device_id, ip_address)
+    return StreamingResponse(_event_stream(device_id, ip_address), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # Админские эндпоинты
+def encode_cursor(positions: list) -> str:
+    """Непрозрачный курсор страницы: для каждого шарда (last_seen, id) последней выданной строки"""
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(positions) != len(shards):
+            raise ValueError
+        return [None if p is None else (str(p[0]), int(p[1])) for p in positions]
+    except (ValueError, TypeError, IndexError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _since_timestamp(since: Optional[datetime]) -> Optional[str]:
+    """Приводит ``since`` к формату CURRENT_TIMESTAMP (UTC) для сравнения с last_seen"""
+    if since is None:
+        return None
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc)
+    return since.strftime('%Y-%m-%d %H:%M:%S')
+
+async def _users_page(limit: int, after: list, active_only: bool, since: Optional[str]):
+    """Страница пользователей из всех шардов по убыванию (last_seen, id).
+
+    Каждый шард отдает до ``limit`` строк после своей позиции, страницы
+    сливаются. Возвращает ``(строки, позиции следующей страницы или None)``.
+    """
+    pages = await asyncio.gather(*(
+        shard.db.run(repository.users_page, limit, position, active_only, since)
+        for shard, position in zip(shards, after)
+    ))
+    rows, taken = merge_pages(pages, limit, key=lambda row: (row["last_seen"], row["id"]))
+    if not has_more(pages, taken, limit):
+        return rows, None
+    return rows, [(row["last_seen"], row["id"]) if row else position
+                  for row, position in zip(taken, after)]
+
+def _admin_user(row: dict) -> dict:
+    """Строка users_page в виде AdminUserStats, без построения модели"""
+    del row["id"]
+    row["is_active"] = bool(row["is_active"])
+    return row
+
 @app.get("/admin/users", response_model=List[AdminUserStats])
-async def get_all_users():
-    cursor = db_conn.cursor()
-    cursor.execute('''
-        SELECT u.device_id, u.balance, u.total_traffic_mb, u.ip_address, 
-               u.created_at, u.last_seen, u.is_active,
-               COUNT(CASE WHEN a.status = 'completed' THEN 1 END) as completed_count
-        FROM users u
-        LEFT JOIN assignments a ON u.id = a.user_id
-        GROUP BY u.id
-        ORDER BY u.last_seen DESC
-    ''')
-    
-    users = []
-    for user in cursor.fetchall():
-        users.append(AdminUserStats(
-            device_id=user[0],
-            balance=user[1],
-            total_completed=user[7] or 0,
-            total_traffic_mb=user[2],
-            ip_address=user[3],
-            created_at=user[4],
-            last_seen=user[5],
-            is_active=bool(user[6])
-        ))
-    
-    return users
+async def get_all_users(response: Response,
+                        limit: int = Query(ADMIN_USERS_PAGE_SIZE, ge=1, le=ADMIN_USERS_MAX_PAGE),
+                        cursor: Optional[str] = None,
+                        active_only: bool = False,
+                        since: Optional[datetime] = None):
+    """Страница пользователей; курсор следующей страницы — в заголовке ``X-Next-Cursor``"""
+    after = decode_cursor(cursor) if cursor else [None] * len(shards)
+    rows, positions = await _users_page(limit, after, active_only, _since_timestamp(since))
+    
+    if positions:
+        response.headers["X-Next-Cursor"] = encode_cursor(positions)
+    users = [_admin_user(row) for row in rows]
+    if FAST_SERIALIZATION:
+        # Строки своей базы не проверяем повторно; схема — из response_model
+        return FastJSONResponse(users, headers=dict(response.headers))
+    return [AdminUserStats(**user) for user in users]
 
-@app.get("/admin/stats")
-async def get_stats():
-    cursor = db_conn.cursor()
-    
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM tasks WHERE is_active = 1')
-    active_tasks = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM assignments WHERE status = "completed"')
-    total_completed = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT SUM(balance) FROM users')
-    total_rewards = cursor.fetchone()[0] or 0
-    
-    cursor.execute('SELECT SUM(total_traffic_mb) FROM users')
-    total_traffic = cursor.fetchone()[0] or 0
-    
-    # Активные пользователи (были онлайн последние 24 часа)
-    cursor.execute('''
-        SELECT COUNT(*) FROM users 
-        WHERE last_seen > datetime('now', '-24 hours')
-    ''')
-    active_users_24h = cursor.fetchone()[0]
-    
+async def _export_users(format: str, active_only: bool, since: Optional[str]):
+    """Выгрузка постранично: в памяти не больше одной страницы на шард"""
+    if format == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(ADMIN_USER_COLUMNS)
+        yield buffer.getvalue()
+    
+    after = [None] * len(shards)
+    while after:
+        rows, after = await _users_page(EXPORT_PAGE_SIZE, after, active_only, since)
+        if not rows:
+            break
+        
+        if format == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows([row[column] for column in ADMIN_USER_COLUMNS]
+                                         for row in rows)
+            yield buffer.getvalue()
+        else:
+            yield b"".join(dumps(_admin_user(row)) + b"\n" for row in rows)
+
+@app.get("/admin/users/export")
+async def export_users(format: Literal["ndjson", "csv"] = "ndjson",
+                       active_only: bool = False,
+                       since: Optional[datetime] = None):
+    """Потоковая выгрузка всех пользователей в NDJSON или CSV"""
+    if format == "csv":
+        media_type = "text/csv; charset=utf-8"
+        headers = {"Content-Disposition": 'attachment; filename="users.csv"'}
+    else:
+        media_type = "application/x-ndjson"
+        headers = {}
+    return StreamingResponse(_export_users(format, active_only, _since_timestamp(since)),
+                             media_type=media_type, headers=headers)
+
+# Шаблоны есть в каждом шарде, их счетчик берем из первого
+SHARED_STATS = ("active_tasks",)
+
+async def _get_stats(fresh: bool = False):
+    per_shard = await shards.run_all(repository.read_stats, fresh)
+    stats = {key: per_shard[0][key] if key in SHARED_STATS else sum(s[key] for s in per_shard)
+             for key in per_shard[0]}
     return {
-        "total_users": total_users,
-        "active_users_24h": active_users_24h,
-        "active_tasks": active_tasks,
-        "total_completed_assignments": total_completed,
-        "total_rewards_issued": round(total_rewards, 2),
-        "total_traffic_used_mb": round(total_traffic, 2)
+        "total_users": int(stats["total_users"]),
+        "active_users_24h": int(stats["active_users_24h"]),
+        "active_tasks": int(stats["active_tasks"]),
+        "total_completed_assignments": int(stats["total_completed_assignments"]),
+        "total_rewards_issued": round(stats["total_rewards_issued"], 2),
+        "total_traffic_used_mb": round(stats["total_traffic_used_mb"], 2)
     }
 
+@app.get("/admin/stats")
+async def get_stats(request: Request, response: Response, fresh: bool = False):
+    """Сводная статистика; ``?fresh=1`` пересчитывает ее по исходным таблицам"""
+    if fresh:
+        return await _get_stats(True)
+    
+    cached = responses.get("stats")
+    if cached:
+        version, stats = cached
+    else:
+        version = responses.version("stats")
+        stats = await _get_stats()
+        responses.set("stats", version, stats)
+    
+    if responses.enabled:
+        etag = responses.etag(version)
+        if not_modified(request, response, "stats", etag, cached is not None):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return stats
+
+# Гранулярность сводок: (шаг корзины, формат корзины, период по умолчанию)
+ANALYTICS_GRANULARITY = {
+    "hour": (timedelta(hours=1), "%Y-%m-%d %H:00:00", timedelta(days=7)),
+    "day": (timedelta(days=1), "%Y-%m-%d", timedelta(days=30)),
+}
+
+def _utc_naive(value: datetime) -> datetime:
+    """Время в UTC без зоны, как CURRENT_TIMESTAMP в базе"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+@app.get("/admin/analytics")
+async def get_analytics(granularity: Literal["hour", "day"] = "hour",
+                        start: Optional[datetime] = None,
+                        end: Optional[datetime] = None,
+                        device_id: Optional[str] = None,
+                        task_id: Optional[int] = None,
+                        group_by: Literal["none", "task"] = "none"):
+    """Завершения, награды и трафик по часам или дням из сводок.
+
+    Читает по строке на корзину (и шаблон), а не по назначению; корзины
+    без завершений в ответ не попадают.
+    """
+    step, bucket_format, default_period = ANALYTICS_GRANULARITY[granularity]
+    end = _utc_naive(end) if end else datetime.now(timezone.utc).replace(tzinfo=None)
+    start = _utc_naive(start) if start else end - default_period
+    if start > end:
+        raise HTTPException(status_code=422, detail="start must not be after end")
+    if (end - start) / step > ANALYTICS_MAX_BUCKETS:
+        raise HTTPException(status_code=422, detail=f"At most {ANALYTICS_MAX_BUCKETS} buckets per request")
+    first, last = start.strftime(bucket_format), end.strftime(bucket_format)
+    by_task = group_by == "task"
+    
+    if device_id is not None:
+        shard = shards.for_device(device_id)
+        user = await shard.db.run(repository.find_user, device_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        per_shard = [await shard.db.run(repository.rollup_range, granularity, first, last,
+                                        user[0], task_id, by_task)]
+    else:
+        per_shard = await shards.run_all(repository.rollup_range, granularity, first, last,
+                                         0, task_id, by_task)
+    
+    totals = {}
+    for rows in per_shard:
+        for bucket, task, completions, reward, traffic_mb in rows:
+            total = totals.setdefault((bucket, task), [0, 0.0, 0.0])
+            total[0] += completions
+            total[1] += reward
+            total[2] += traffic_mb
+    
+    buckets = []
+    for (bucket, task), (completions, reward, traffic_mb) in sorted(totals.items()):
+        item = {"bucket": bucket, "task_id": task} if by_task else {"bucket": bucket}
+        item.update(completions=completions, reward=round(reward, 2), traffic_mb=round(traffic_mb, 2))
+        buckets.append(item)
+    return {"granularity": granularity, "start": first, "end": last, "buckets": buckets}
+
+def _create_task(conn, shard: Shard, params: tuple, task_id: Optional[int] = None):
+    task_id = repository.insert_task(conn, params, task_id)
+    shard.template_cache.invalidate()
+    return task_id
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return metrics.REGISTRY.render()
+
 @app.post("/admin/tasks")
 async def create_task(url_template: str, title_template: str = "Посетить сайт", 
                      description_template: str = "", min_duration: int = 180,
                      max_duration: int = 1440, min_wait: int = 900, 
                      max_wait: int = 1800, base_reward: float = 0.10):
-    cursor = db_conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO tasks 
-        (url_template, title_template, description_template, min_duration, 
-         max_duration, min_wait, max_wait, base_reward) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (url_template, title_template, description_template, min_duration,
-          max_duration, min_wait, max_wait, base_reward))
-    
-    task_id = cursor.lastrowid
-    db_conn.commit()
-    
+    params = (url_template, title_template, description_template,
+              min_duration, max_duration, min_wait, max_wait, base_reward)
+    # id выдает первый шард, остальные получают копию под тем же id
+    task_id = await shards[0].db.write(_create_task, shards[0], params)
+    await asyncio.gather(*(shard.db.write(_create_task, shard, params, task_id)
+                           for shard in shards.shards[1:]))
+    responses.bump("stats")
     return {"message": "Task template created", "task_id": task_id}
 
+profiler.mark("app")
+
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    
+    parser = argparse.ArgumentParser(description="Advanced Task Tracker API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+                        help="Число процессов uvicorn на одну базу")
+    args = parser.parse_args()
+    
+    if args.workers > 1:
+        # Воркеры импортируют приложение сами, каждый со своими соединениями;
+        # WEB_CONCURRENCY выключает в них кэш ответов (см. config.py)
+        os.environ["WEB_CONCURRENCY"] = str(args.workers)
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, ws="none")
+    else:
+        # Процесс точно один: кэш ответов по умолчанию включен (см. config.py)
+        if "RESPONSE_CACHE_SIZE" not in os.environ:
+            responses = VersionedCache(capacity=SINGLE_PROCESS_RESPONSE_CACHE_SIZE,
+                                       ttl=RESPONSE_CACHE_TTL_SEC)
+        # WebSocket не используется (push — через SSE): не импортируем его реализацию
+        uvicorn.run(app, host=args.host, port=args.port, ws="none")
@@ -0,0 +1,379 @@
+"""Обслуживание базы: сверка денормализованных данных и фоновые задачи
+
+Запуск из командной строки:
+    python maintenance.py reconcile [--fix] [--db tasks.db]
+    python maintenance.py compact-ledger [--days 30]
+    python maintenance.py expire [--grace 600]
+    python maintenance.py archive [--days 7]
+    python maintenance.py reconcile-stats [--fix]
+    python maintenance.py backfill-rollups [--since "2024-01-01 00:00:00"]
+
+База берется из DATABASE_URL, при DB_SHARDS > 1 команда выполняется для
+каждого шарда; ``--db`` и ``--shards`` переопределяют их.
+"""
+import argparse
+import sqlite3
+import sys
+from collections import Counter
+
+from config import DATABASE_URL, DB_SHARDS
+from migrations import ROLLUP_BUCKETS, backfill_rollups, migrate
+from sharding import shard_urls
+from storage import FileLock, database_path
+
+# Счетчики в users, которые должны совпадать с количеством строк assignments
+COUNTER_COLUMNS = {
+    'total_completed': 'completed',
+    'total_expired': 'expired',
+    'active_assignments': 'assigned',
+}
+
+
+# Столбцы назначения, общие для assignments и assignments_archive
+ASSIGNMENT_COLUMNS = (
+    'id, user_id, task_id, assigned_url, assigned_title, assigned_description, '
+    'visit_duration_sec, wait_duration_sec, reward, ip_address, traffic_used_mb, '
+    'status, assigned_at, completed_at'
+)
+
+
+def _raw_counts_sql() -> str:
+    sums = ', '.join(f"SUM(status = '{status}') AS {status}" for status in COUNTER_COLUMNS.values())
+    return f'''
+        SELECT user_id, {sums} FROM (
+            SELECT user_id, status FROM assignments
+            UNION ALL
+            SELECT user_id, status FROM assignments_archive
+        ) GROUP BY user_id
+    '''
+
+
+def reconcile_counters(conn, fix: bool = False) -> list:
+    """Сверяет счетчики users с assignments.
+
+    Возвращает список расхождений ``(device_id, столбец, в users, по строкам)``.
+    С ``fix=True`` исправляет счетчики в той же транзакции.
+    """
+    columns = list(COUNTER_COLUMNS)
+    selected = ', '.join(f'u.{c}, COALESCE(r.{COUNTER_COLUMNS[c]}, 0)' for c in columns)
+
+    # BEGIN IMMEDIATE: писатель приложения не изменит счетчики посреди сверки
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(f'''
+            SELECT u.id, u.device_id, {selected}
+            FROM users u
+            LEFT JOIN ({_raw_counts_sql()}) r ON r.user_id = u.id
+        ''').fetchall()
+
+        mismatches = []
+        fixes = []
+        for row in rows:
+            user_id, device_id, values = row[0], row[1], row[2:]
+            for i, column in enumerate(columns):
+                stored, actual = values[2 * i], values[2 * i + 1]
+                if stored != actual:
+                    mismatches.append((device_id, column, stored, actual))
+                    fixes.append((column, actual, user_id))
+
+        if fix:
+            for column, actual, user_id in fixes:
+                conn.execute(f'UPDATE users SET {column} = ? WHERE id = ?', (actual, user_id))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return mismatches
+
+
+def reconcile_balances(conn, fix: bool = False, tolerance: float = 1e-6) -> list:
+    """Сверяет кэшированные balance и total_traffic_mb с журналом начислений.
+
+    Источник истины — ``ledger_snapshots`` плюс еще не свернутые записи ``ledger``.
+    Формат результата такой же, как у ``reconcile_counters``.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute('''
+            SELECT u.id, u.device_id, u.balance, u.total_traffic_mb,
+                   COALESCE(s.reward, 0) + COALESCE(l.reward, 0),
+                   COALESCE(s.traffic_mb, 0) + COALESCE(l.traffic_mb, 0)
+            FROM users u
+            LEFT JOIN ledger_snapshots s ON s.user_id = u.id
+            LEFT JOIN (SELECT user_id, SUM(reward) AS reward, SUM(traffic_mb) AS traffic_mb
+                       FROM ledger GROUP BY user_id) l ON l.user_id = u.id
+        ''').fetchall()
+
+        mismatches = []
+        for user_id, device_id, balance, traffic, ledger_balance, ledger_traffic in rows:
+            for column, stored, actual in (('balance', balance, ledger_balance),
+                                           ('total_traffic_mb', traffic, ledger_traffic)):
+                if abs(stored - actual) > tolerance:
+                    mismatches.append((device_id, column, stored, actual))
+                    if fix:
+                        conn.execute(f'UPDATE users SET {column} = ? WHERE id = ?', (actual, user_id))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return mismatches
+
+
+def compact_ledger(conn, older_than_days: float = 30, batch_size: int = 5000) -> int:
+    """Сворачивает до ``batch_size`` старых записей журнала в ledger_snapshots.
+
+    Не управляет транзакцией: вызывается писателем приложения (или из CLI
+    с последующим commit). Возвращает количество свернутых записей.
+    """
+    cutoff = f'{-older_than_days} days'
+    max_id = conn.execute('''
+        SELECT MAX(id) FROM (
+            SELECT id FROM ledger WHERE created_at < datetime('now', ?)
+            ORDER BY id LIMIT ?
+        )
+    ''', (cutoff, batch_size)).fetchone()[0]
+    if max_id is None:
+        return 0
+
+    conn.execute('''
+        INSERT INTO ledger_snapshots (user_id, reward, traffic_mb, entries, last_entry_id)
+        SELECT user_id, SUM(reward), SUM(traffic_mb), COUNT(*), MAX(id) FROM ledger
+        WHERE id <= ? AND created_at < datetime('now', ?)
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            reward = reward + excluded.reward,
+            traffic_mb = traffic_mb + excluded.traffic_mb,
+            entries = entries + excluded.entries,
+            last_entry_id = MAX(last_entry_id, excluded.last_entry_id),
+            updated_at = CURRENT_TIMESTAMP
+    ''', (max_id, cutoff))
+    return conn.execute(
+        "DELETE FROM ledger WHERE id <= ? AND created_at < datetime('now', ?)",
+        (max_id, cutoff)
+    ).rowcount
+
+
+def expire_assignments(conn, grace_sec: float = 600, batch_size: int = 1000) -> int:
+    """Помечает просроченными до ``batch_size`` брошенных назначений.
+
+    Назначение просрочено, если его срок ``due_at`` прошел больше
+    ``grace_sec`` секунд назад. Срок отсчитывается от конца предыдущих
+    назначений в очереди пользователя (см. ``repository.insert_assignments``),
+    поэтому очередь из ``?count=N`` не истекает раньше времени. Завершить
+    просроченное назначение уже нельзя. Счетчики пользователей меняются в
+    той же транзакции. Возвращает число назначений.
+    """
+    rows = conn.execute('''
+        UPDATE assignments SET status = 'expired'
+        WHERE id IN (
+            SELECT id FROM assignments
+            WHERE status = 'assigned' AND due_at < datetime('now', ?)
+            ORDER BY due_at LIMIT ?
+        )
+        RETURNING user_id
+    ''', (f'{-grace_sec} seconds', batch_size)).fetchall()
+
+    expired_per_user = Counter(row[0] for row in rows)
+    conn.executemany('''
+        UPDATE users SET
+        active_assignments = active_assignments - ?,
+        total_expired = total_expired + ?
+        WHERE id = ?
+    ''', [(n, n, user_id) for user_id, n in expired_per_user.items()])
+    return len(rows)
+
+
+def archive_assignments(conn, older_than_days: float = 7, batch_size: int = 1000) -> int:
+    """Переносит до ``batch_size`` завершенных и просроченных назначений в архив.
+
+    Горячая таблица assignments остается размером примерно с рабочий набор.
+    Возвращает количество перенесенных строк.
+    """
+    cutoff = f'{-older_than_days} days'
+    max_id = conn.execute('''
+        SELECT MAX(id) FROM (
+            SELECT id FROM assignments
+            WHERE status IN ('completed', 'expired') AND assigned_at < datetime('now', ?)
+            ORDER BY id LIMIT ?
+        )
+    ''', (cutoff, batch_size)).fetchone()[0]
+    if max_id is None:
+        return 0
+
+    condition = "id <= ? AND status IN ('completed', 'expired') AND assigned_at < datetime('now', ?)"
+    conn.execute(f'''
+        INSERT INTO assignments_archive ({ASSIGNMENT_COLUMNS})
+        SELECT {ASSIGNMENT_COLUMNS} FROM assignments WHERE {condition}
+    ''', (max_id, cutoff))
+    return conn.execute(f'DELETE FROM assignments WHERE {condition}', (max_id, cutoff)).rowcount
+
+
+def prune_activity_buckets(conn, keep_hours: float = 48) -> int:
+    """Удаляет корзины активности, которые уже не попадают ни в одно окно"""
+    return conn.execute(
+        "DELETE FROM activity_buckets WHERE bucket < datetime('now', ?)",
+        (f'{-keep_hours} hours',)
+    ).rowcount
+
+
+def compute_stats(conn) -> dict:
+    """Полный пересчет агрегатов /admin/stats по исходным таблицам"""
+    def scalar(sql):
+        return conn.execute(sql).fetchone()[0] or 0
+
+    return {
+        'total_users': scalar('SELECT COUNT(*) FROM users'),
+        'active_users_24h': scalar(
+            "SELECT COUNT(*) FROM users WHERE last_seen > datetime('now', '-24 hours')"),
+        'active_tasks': scalar('SELECT COUNT(*) FROM tasks WHERE is_active = 1'),
+        'total_completed_assignments': scalar(
+            "SELECT COUNT(*) FROM assignments WHERE status = 'completed'")
+            + scalar("SELECT COUNT(*) FROM assignments_archive WHERE status = 'completed'"),
+        'total_rewards_issued': scalar('SELECT SUM(balance) FROM users'),
+        'total_traffic_used_mb': scalar('SELECT SUM(total_traffic_mb) FROM users'),
+    }
+
+
+def reconcile_stats(conn, fix: bool = False, tolerance: float = 1e-6) -> list:
+    """Сверяет таблицу stats с полным пересчетом; возвращает ``(ключ, в stats, по строкам)``"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        stored = dict(conn.execute('SELECT key, value FROM stats').fetchall())
+        actual = compute_stats(conn)
+        mismatches = [(key, stored.get(key), value) for key, value in actual.items()
+                      if key in stored and abs(stored[key] - value) > tolerance]
+        if fix:
+            conn.executemany('UPDATE stats SET value = ? WHERE key = ?',
+                             [(value, key) for key, _, value in mismatches])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return mismatches
+
+
+def reconcile_rollups(conn, tolerance: float = 1e-6) -> list:
+    """Сверяет общие корзины сводок (user_id = 0) с назначениями.
+
+    Возвращает ``(таблица, корзина, task_id, в сводке, по строкам)``, где
+    значения — ``(completions, reward, traffic_mb)``. Ничего не исправляет:
+    для этого есть ``backfill_rollups``.
+    """
+    mismatches = []
+    for table, bucket in ROLLUP_BUCKETS.items():
+        stored = {(row[0], row[1]): row[2:] for row in conn.execute(
+            f'SELECT bucket, task_id, completions, reward, traffic_mb FROM {table} WHERE user_id = 0')}
+        actual = {(row[0], row[1]): row[2:] for row in conn.execute(f'''
+            SELECT {bucket.format(ts='completed_at')}, task_id,
+                   COUNT(*), TOTAL(reward), TOTAL(traffic_used_mb)
+            FROM (
+                SELECT task_id, reward, traffic_used_mb, COALESCE(completed_at, assigned_at) AS completed_at
+                FROM assignments WHERE status = 'completed'
+                UNION ALL
+                SELECT task_id, reward, traffic_used_mb, COALESCE(completed_at, assigned_at) AS completed_at
+                FROM assignments_archive WHERE status = 'completed'
+            )
+            GROUP BY 1, 2
+        ''')}
+        for key in sorted(stored.keys() | actual.keys()):
+            have, want = stored.get(key, (0, 0.0, 0.0)), actual.get(key, (0, 0.0, 0.0))
+            if any(abs(a - b) > tolerance for a, b in zip(have, want)):
+                mismatches.append((table, *key, have, want))
+    return mismatches
+
+
+def _run_batches(conn, fn, *args) -> int:
+    total = 0
+    while True:
+        done = fn(conn, *args)
+        conn.commit()
+        if not done:
+            return total
+        total += done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Обслуживание базы заданий')
+    parser.add_argument('--db', help='Файл базы (по умолчанию — из DATABASE_URL)')
+    parser.add_argument('--shards', type=int, default=DB_SHARDS,
+                        help='Число шардов: команда выполняется для каждого файла')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    reconcile = commands.add_parser('reconcile', help='Сверить счетчики и балансы users с assignments и журналом')
+    reconcile.add_argument('--fix', action='store_true', help='Исправить расхождения')
+
+    compact = commands.add_parser('compact-ledger', help='Свернуть старые записи журнала начислений')
+    compact.add_argument('--days', type=float, default=30, help='Сворачивать записи старше N дней')
+
+    expire = commands.add_parser('expire', help='Просрочить брошенные назначения')
+    expire.add_argument('--grace', type=float, default=600, help='Запас сверх visit + wait, секунд')
+
+    archive = commands.add_parser('archive', help='Перенести старые назначения в архив')
+    archive.add_argument('--days', type=float, default=7, help='Переносить назначения старше N дней')
+
+    stats = commands.add_parser('reconcile-stats', help='Сверить агрегаты /admin/stats с таблицами')
+    stats.add_argument('--fix', action='store_true', help='Исправить расхождения')
+
+    rollups = commands.add_parser('backfill-rollups', help='Пересчитать сводки по часам и дням')
+    rollups.add_argument('--since', help='С корзины, содержащей это время UTC (по умолчанию — все)')
+
+    args = parser.parse_args(argv)
+    url = f'sqlite:///{args.db}' if args.db else DATABASE_URL
+    paths = [database_path(shard_url) for shard_url in shard_urls(url, args.shards)]
+    code = 0
+    for path in paths:
+        if len(paths) > 1:
+            print(f'Шард {path}:')
+        # База может быть открыта работающими воркерами
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            with FileLock(f'{path}.lock'):
+                migrate(conn)
+            code = max(code, _run_command(conn, args))
+        finally:
+            conn.close()
+    return code
+
+
+def _run_command(conn, args) -> int:
+    if args.command == 'reconcile':
+        mismatches = reconcile_counters(conn, fix=args.fix) + reconcile_balances(conn, fix=args.fix)
+        for device_id, column, stored, actual in mismatches:
+            print(f'{device_id}: {column} = {stored}, по строкам {actual}')
+        print(f'Расхождений: {len(mismatches)}' + (' (исправлено)' if args.fix and mismatches else ''))
+        return 1 if mismatches and not args.fix else 0
+
+    if args.command == 'compact-ledger':
+        print(f'Свернуто записей журнала: {_run_batches(conn, compact_ledger, args.days)}')
+        return 0
+
+    if args.command == 'expire':
+        print(f'Просрочено назначений: {_run_batches(conn, expire_assignments, args.grace)}')
+        return 0
+
+    if args.command == 'archive':
+        print(f'Перенесено в архив: {_run_batches(conn, archive_assignments, args.days)}')
+        return 0
+
+    if args.command == 'reconcile-stats':
+        mismatches = reconcile_stats(conn, fix=args.fix)
+        for key, stored, actual in mismatches:
+            print(f'{key} = {stored}, по таблицам {actual}')
+        print(f'Расхождений: {len(mismatches)}' + (' (исправлено)' if args.fix and mismatches else ''))
+        return 1 if mismatches and not args.fix else 0
+
+    if args.command == 'backfill-rollups':
+        # Одна транзакция: завершения во время пересчета не потеряются
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = backfill_rollups(conn, args.since)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f'Строк сводок: {rows}')
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
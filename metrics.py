@@ -0,0 +1,230 @@
+"""Метрики горячего пути в текстовом формате Prometheus
+
+Гистограммы задержек по маршрутам и именованным запросам, счетчики строк,
+длительность групповых коммитов и повторов при "database is locked".
+Все метрики живут в процессе и дешевы настолько, чтобы не выключать их.
+"""
+import logging
+import random
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Сколько инструкций VM SQLite между вызовами progress handler
+VM_STEP_GRANULARITY = 1000
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f'{self.name}{_format_labels(self.labels, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя — +Inf), сумма, количество]
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                bucket_labels = _format_labels(self.labels + ('le',), labels + (bound,))
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self._metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+http_request_duration = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Длительность обработки HTTP-запроса',
+    ('method', 'route', 'status'))
+db_query_duration = REGISTRY.histogram(
+    'db_query_duration_seconds', 'Длительность запроса к БД, включая выборку строк', ('query',))
+db_query_rows = REGISTRY.counter(
+    'db_query_rows_total', 'Строк возвращено (SELECT, RETURNING) или изменено (DML)', ('query',))
+db_query_vm_steps = REGISTRY.counter(
+    'db_query_vm_steps_total',
+    f'Инструкций VM SQLite (с точностью до {VM_STEP_GRANULARITY}), оценка объема сканирования',
+    ('query',))
+db_locked_retries = REGISTRY.counter(
+    'db_locked_retries_total', 'Повторы запроса после "database is locked"', ('query',))
+db_commit_duration = REGISTRY.histogram(
+    'db_commit_duration_seconds', 'Длительность COMMIT групповой транзакции писателя')
+db_commit_batch_size = REGISTRY.histogram(
+    'db_commit_batch_size', 'Операций в одной групповой транзакции', buckets=SIZE_BUCKETS)
+idempotency_requests = REGISTRY.counter(
+    'idempotency_requests_total',
+    'Завершения по ключу идемпотентности: hit — из кэша, inflight — ждали первый запрос, miss — в БД',
+    ('result',))
+
+response_cache_requests = REGISTRY.counter(
+    'response_cache_requests_total',
+    'Кэш ответов с ETag: not_modified — 304, hit — 200 из кэша, miss — запрос к БД',
+    ('endpoint', 'result'))
+rejected_requests = REGISTRY.counter(
+    'rejected_requests_total',
+    'Отклоненные до обращения к БД запросы: лимиты device/ip (429), write_queue/loop_lag (503)',
+    ('reason',))
+
+
+# Журнал медленных запросов выключен, пока не вызван configure_slow_query_log
+slow_query_threshold = float('inf')
+slow_query_sample_rate = 1.0
+
+LOCKED_RETRIES = 3
+LOCKED_BACKOFF = 0.05
+
+_vm = threading.local()
+
+
+def _vm_progress():
+    _vm.steps = getattr(_vm, 'steps', 0) + VM_STEP_GRANULARITY
+    return 0
+
+
+def instrument_connection(conn):
+    """Подключает подсчет инструкций VM к соединению"""
+    conn.set_progress_handler(_vm_progress, VM_STEP_GRANULARITY)
+
+
+def configure_slow_query_log(threshold_ms: float, sample_rate: float = 1.0):
+    """Писать в лог долю ``sample_rate`` запросов дольше ``threshold_ms`` вместе с параметрами"""
+    global slow_query_threshold, slow_query_sample_rate
+    slow_query_threshold = threshold_ms / 1000
+    slow_query_sample_rate = sample_rate
+
+
+def observe_commit(duration: float, batch_size: int):
+    db_commit_duration.observe(duration)
+    db_commit_batch_size.observe(batch_size)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, который меряет именованные запросы.
+
+    ``cursor.execute(sql, params, name='...')``: для запросов без строк
+    результата метрика пишется сразу, для SELECT и RETURNING — после
+    первого ``fetchone``/``fetchall``, чтобы учесть время выборки.
+    """
+
+    _pending = None
+
+    def execute(self, sql, parameters=(), *, name='unnamed'):
+        started = time.perf_counter()
+        steps = getattr(_vm, 'steps', 0)
+        for attempt in range(LOCKED_RETRIES + 1):
+            try:
+                super().execute(sql, parameters)
+                break
+            except sqlite3.OperationalError as exc:
+                if 'database is locked' not in str(exc) or attempt == LOCKED_RETRIES:
+                    raise
+                db_locked_retries.inc(1, name)
+                time.sleep(LOCKED_BACKOFF * (attempt + 1))
+
+        self._pending = (name, sql, parameters, started, steps)
+        if self.description is None:
+            self._finish(self.rowcount)
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if self._pending:
+            self._finish(0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self._pending:
+            self._finish(len(rows))
+        return rows
+
+    def _finish(self, rows: int):
+        name, sql, parameters, started, steps = self._pending
+        self._pending = None
+        duration = time.perf_counter() - started
+        db_query_duration.observe(duration, name)
+        if rows > 0:
+            db_query_rows.inc(rows, name)
+        vm_steps = getattr(_vm, 'steps', 0) - steps
+        if vm_steps:
+            db_query_vm_steps.inc(vm_steps, name)
+        if duration >= slow_query_threshold and random.random() < slow_query_sample_rate:
+            logger.warning('Медленный запрос %s: %.1f мс, параметры %r\n%s',
+                           name, duration * 1000, parameters, ' '.join(sql.split()))
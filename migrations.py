@@ -0,0 +1,410 @@
+"""Версионированные миграции схемы (версия хранится в PRAGMA user_version)
+
+Миграции применяются один раз при старте: если версия базы уже последняя,
+``migrate`` не выполняет ни одного DDL-запроса. Что горячие запросы
+используют индексы, проверяет tests/test_query_plans.py.
+"""
+
+DEFAULT_TASK_TEMPLATES = [
+    ('https://www.google.com/search?q={keyword}', 'Поиск в Google', 'Выполните поисковый запрос', 180, 900, 600, 1200, 0.08),
+    ('https://www.youtube.com/results?search_query={keyword}', 'Поиск на YouTube', 'Посмотрите видео', 300, 1440, 900, 1800, 0.15),
+    ('https://github.com/search?q={keyword}', 'Поиск на GitHub', 'Изучите репозитории', 180, 600, 600, 1200, 0.10),
+    ('https://www.amazon.com/s?k={keyword}', 'Поиск на Amazon', 'Посмотрите товары', 240, 1200, 600, 1500, 0.12),
+    ('https://twitter.com/search?q={keyword}', 'Поиск в Twitter', 'Посмотрите твиты', 180, 480, 300, 900, 0.07),
+]
+
+
+def _seed_tasks(conn):
+    """Добавляем шаблоны заданий, если их нет"""
+    if conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0] == 0:
+        conn.executemany('''
+            INSERT INTO tasks (url_template, title_template, description_template,
+                             min_duration, max_duration, min_wait, max_wait, base_reward)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', DEFAULT_TASK_TEMPLATES)
+
+
+# Корзины сводок по времени завершения (у старых строк без completed_at — по
+# времени выдачи): таблица -> выражение корзины от отметки времени
+ROLLUP_BUCKETS = {
+    'rollups_hourly': "substr({ts}, 1, 13) || ':00:00'",
+    'rollups_daily': "substr({ts}, 1, 10)",
+}
+
+
+def _rollup_upsert(row: str, sign: str) -> str:
+    """Тело триггера: добавляет (или вычитает) назначение ``row`` в корзины
+    пользователя и в общие корзины (user_id = 0)"""
+    statements = []
+    for table, bucket in ROLLUP_BUCKETS.items():
+        bucket = bucket.format(ts=f'COALESCE({row}.completed_at, {row}.assigned_at)')
+        values = f"{bucket}, {row}.task_id, {sign}1, {sign}{row}.reward, {sign}COALESCE({row}.traffic_used_mb, 0)"
+        statements.append(f'''
+            INSERT INTO {table} (user_id, bucket, task_id, completions, reward, traffic_mb)
+            VALUES ({row}.user_id, {values}), (0, {values})
+            ON CONFLICT (user_id, bucket, task_id) DO UPDATE SET
+                completions = completions + excluded.completions,
+                reward = reward + excluded.reward,
+                traffic_mb = traffic_mb + excluded.traffic_mb;
+        ''')
+    return ''.join(statements)
+
+
+def backfill_rollups(conn, since: str = None) -> int:
+    """Пересчитывает корзины сводок начиная с корзины, содержащей ``since``
+    (без него — все), по assignments и assignments_archive. Возвращает число строк"""
+    total = 0
+    for table, bucket in ROLLUP_BUCKETS.items():
+        start = conn.execute(f"SELECT {bucket.format(ts='?')}", (since,)).fetchone()[0] if since else ''
+        conn.execute(f'DELETE FROM {table} WHERE bucket >= ?', (start,))
+        completed = "status = 'completed' AND COALESCE(completed_at, assigned_at) >= ?"
+        total += conn.execute(f'''
+            INSERT INTO {table} (user_id, bucket, task_id, completions, reward, traffic_mb)
+            SELECT user_id, {bucket.format(ts='completed_at')}, task_id,
+                   COUNT(*), TOTAL(reward), TOTAL(traffic_used_mb)
+            FROM (
+                SELECT user_id, task_id, reward, traffic_used_mb,
+                       COALESCE(completed_at, assigned_at) AS completed_at
+                FROM assignments WHERE {completed}
+                UNION ALL
+                SELECT user_id, task_id, reward, traffic_used_mb,
+                       COALESCE(completed_at, assigned_at) AS completed_at
+                FROM assignments_archive WHERE {completed}
+            )
+            GROUP BY 1, 2, 3
+        ''', (start, start)).rowcount
+        conn.execute(f'''
+            INSERT INTO {table} (user_id, bucket, task_id, completions, reward, traffic_mb)
+            SELECT 0, bucket, task_id, SUM(completions), TOTAL(reward), TOTAL(traffic_mb)
+            FROM {table} WHERE user_id != 0 AND bucket >= ?
+            GROUP BY bucket, task_id
+        ''', (start,))
+    return total
+
+
+# (версия, описание, шаги); шаг — SQL-строка или функция fn(conn).
+# Уже выпущенные миграции не редактируются, только добавляются новые.
+MIGRATIONS = [
+    (1, 'Базовая схема', [
+        # IF NOT EXISTS: базы, созданные до появления миграций, имеют user_version = 0
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT UNIQUE NOT NULL,
+            balance REAL DEFAULT 0.0,
+            total_traffic_mb REAL DEFAULT 0.0,
+            ip_address TEXT DEFAULT 'unknown',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url_template TEXT NOT NULL,
+            title_template TEXT DEFAULT 'Посетить сайт',
+            description_template TEXT DEFAULT '',
+            min_duration INTEGER DEFAULT 180,  -- 3 минуты минимум
+            max_duration INTEGER DEFAULT 1440, -- 24 минуты максимум
+            min_wait INTEGER DEFAULT 900,      -- 15 минут ожидания
+            max_wait INTEGER DEFAULT 1800,    -- 30 минут ожидания
+            base_reward REAL DEFAULT 0.10,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS assignments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            assigned_url TEXT NOT NULL,
+            assigned_title TEXT NOT NULL,
+            assigned_description TEXT NOT NULL,
+            visit_duration_sec INTEGER NOT NULL,
+            wait_duration_sec INTEGER NOT NULL,
+            reward REAL NOT NULL,
+            ip_address TEXT DEFAULT 'unknown',
+            traffic_used_mb REAL DEFAULT 0.0,
+            status TEXT DEFAULT 'assigned',
+            assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (task_id) REFERENCES tasks (id)
+        )
+        ''',
+        _seed_tasks,
+    ]),
+    (2, 'Индексы для горячих запросов', [
+        # Активное задание пользователя и счетчики по статусам
+        'CREATE INDEX IF NOT EXISTS idx_assignments_user_status '
+        'ON assignments (user_id, status, assigned_at)',
+        # Выполненные задания: счетчики и множество выполненных шаблонов
+        "CREATE INDEX IF NOT EXISTS idx_assignments_completed "
+        "ON assignments (user_id, task_id) WHERE status = 'completed'",
+        # Невыполненные назначения по времени выдачи
+        "CREATE INDEX IF NOT EXISTS idx_assignments_open "
+        "ON assignments (assigned_at) WHERE status = 'assigned'",
+        # Активность пользователей и сортировка в /admin/users
+        'CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)',
+    ]),
+    (3, 'Денормализованные счетчики назначений в users', [
+        'ALTER TABLE users ADD COLUMN total_completed INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN total_expired INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN active_assignments INTEGER NOT NULL DEFAULT 0',
+        '''
+        UPDATE users SET
+            total_completed = (SELECT COUNT(*) FROM assignments a
+                               WHERE a.user_id = users.id AND a.status = 'completed'),
+            total_expired = (SELECT COUNT(*) FROM assignments a
+                             WHERE a.user_id = users.id AND a.status = 'expired'),
+            active_assignments = (SELECT COUNT(*) FROM assignments a
+                                  WHERE a.user_id = users.id AND a.status = 'assigned')
+        ''',
+    ]),
+    (4, 'Журнал начислений и снимки для его свертки', [
+        # Только добавление: баланс в users — кэш суммы по журналу
+        '''
+        CREATE TABLE ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            assignment_id INTEGER UNIQUE,  -- не больше одного начисления за назначение
+            kind TEXT NOT NULL DEFAULT 'reward',
+            reward REAL NOT NULL DEFAULT 0.0,
+            traffic_mb REAL NOT NULL DEFAULT 0.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (assignment_id) REFERENCES assignments (id)
+        )
+        ''',
+        'CREATE INDEX idx_ledger_user ON ledger (user_id)',
+        # Свернутые старые записи журнала, по одной строке на пользователя
+        '''
+        CREATE TABLE ledger_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            reward REAL NOT NULL DEFAULT 0.0,
+            traffic_mb REAL NOT NULL DEFAULT 0.0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            last_entry_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # Накопленные до появления журнала балансы переносим входящими записями
+        '''
+        INSERT INTO ledger (user_id, kind, reward, traffic_mb)
+        SELECT id, 'opening', balance, total_traffic_mb FROM users
+        WHERE balance != 0 OR total_traffic_mb != 0
+        ''',
+    ]),
+    (5, 'Архив завершенных и просроченных назначений', [
+        '''
+        CREATE TABLE assignments_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            assigned_url TEXT NOT NULL,
+            assigned_title TEXT NOT NULL,
+            assigned_description TEXT NOT NULL,
+            visit_duration_sec INTEGER NOT NULL,
+            wait_duration_sec INTEGER NOT NULL,
+            reward REAL NOT NULL,
+            ip_address TEXT DEFAULT 'unknown',
+            traffic_used_mb REAL DEFAULT 0.0,
+            status TEXT NOT NULL,
+            assigned_at TIMESTAMP,
+            completed_at TIMESTAMP NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX idx_archive_completed "
+        "ON assignments_archive (user_id, task_id) WHERE status = 'completed'",
+    ]),
+    (6, 'Инкрементальные агрегаты для /admin/stats', [
+        'CREATE TABLE stats (key TEXT PRIMARY KEY, value REAL NOT NULL DEFAULT 0) WITHOUT ROWID',
+        '''
+        INSERT INTO stats (key, value) VALUES
+            ('total_users', (SELECT COUNT(*) FROM users)),
+            ('active_tasks', (SELECT COUNT(*) FROM tasks WHERE is_active = 1)),
+            ('total_completed_assignments',
+             (SELECT COUNT(*) FROM assignments WHERE status = 'completed')
+             + (SELECT COUNT(*) FROM assignments_archive WHERE status = 'completed')),
+            ('total_rewards_issued', (SELECT COALESCE(SUM(balance), 0) FROM users)),
+            ('total_traffic_used_mb', (SELECT COALESCE(SUM(total_traffic_mb), 0) FROM users))
+        ''',
+        # Число пользователей по 10-минутным корзинам их last_seen
+        'CREATE TABLE activity_buckets (bucket TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID',
+        '''
+        INSERT INTO activity_buckets (bucket, users)
+        SELECT substr(last_seen, 1, 15) || '0:00', COUNT(*) FROM users
+        WHERE last_seen IS NOT NULL GROUP BY 1
+        ''',
+        '''
+        CREATE TRIGGER stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'total_users';
+            UPDATE stats SET value = value + NEW.balance WHERE key = 'total_rewards_issued';
+            UPDATE stats SET value = value + NEW.total_traffic_mb WHERE key = 'total_traffic_used_mb';
+            INSERT INTO activity_buckets (bucket, users) VALUES (substr(NEW.last_seen, 1, 15) || '0:00', 1)
+            ON CONFLICT (bucket) DO UPDATE SET users = users + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'total_users';
+            UPDATE stats SET value = value - OLD.balance WHERE key = 'total_rewards_issued';
+            UPDATE stats SET value = value - OLD.total_traffic_mb WHERE key = 'total_traffic_used_mb';
+            UPDATE activity_buckets SET users = users - 1
+            WHERE bucket = substr(OLD.last_seen, 1, 15) || '0:00';
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_users_balance AFTER UPDATE OF balance, total_traffic_mb ON users
+        WHEN NEW.balance != OLD.balance OR NEW.total_traffic_mb != OLD.total_traffic_mb BEGIN
+            UPDATE stats SET value = value + NEW.balance - OLD.balance WHERE key = 'total_rewards_issued';
+            UPDATE stats SET value = value + NEW.total_traffic_mb - OLD.total_traffic_mb
+            WHERE key = 'total_traffic_used_mb';
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_users_last_seen AFTER UPDATE OF last_seen ON users
+        WHEN substr(NEW.last_seen, 1, 15) IS NOT substr(OLD.last_seen, 1, 15) BEGIN
+            UPDATE activity_buckets SET users = users - 1
+            WHERE bucket = substr(OLD.last_seen, 1, 15) || '0:00';
+            INSERT INTO activity_buckets (bucket, users) VALUES (substr(NEW.last_seen, 1, 15) || '0:00', 1)
+            ON CONFLICT (bucket) DO UPDATE SET users = users + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_tasks_insert AFTER INSERT ON tasks WHEN NEW.is_active BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'active_tasks';
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_tasks_active AFTER UPDATE OF is_active ON tasks
+        WHEN NEW.is_active IS NOT OLD.is_active BEGIN
+            UPDATE stats SET value = value + (CASE WHEN NEW.is_active THEN 1 ELSE -1 END)
+            WHERE key = 'active_tasks';
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_tasks_delete AFTER DELETE ON tasks WHEN OLD.is_active BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'active_tasks';
+        END
+        ''',
+        # Перенос в архив (DELETE) счетчик выполненных не уменьшает
+        '''
+        CREATE TRIGGER stats_assignments_insert AFTER INSERT ON assignments
+        WHEN NEW.status = 'completed' BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'total_completed_assignments';
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_assignments_status AFTER UPDATE OF status ON assignments
+        WHEN (NEW.status = 'completed') != (OLD.status = 'completed') BEGIN
+            UPDATE stats SET value = value + (CASE WHEN NEW.status = 'completed' THEN 1 ELSE -1 END)
+            WHERE key = 'total_completed_assignments';
+        END
+        ''',
+    ]),
+    (7, 'Версия шаблонов заданий для кэшей воркеров', [
+        "INSERT INTO stats (key, value) VALUES ('tasks_version', 0)",
+        '''
+        CREATE TRIGGER tasks_version_insert AFTER INSERT ON tasks BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'tasks_version';
+        END
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_update AFTER UPDATE ON tasks BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'tasks_version';
+        END
+        ''',
+        '''
+        CREATE TRIGGER tasks_version_delete AFTER DELETE ON tasks BEGIN
+            UPDATE stats SET value = value + 1 WHERE key = 'tasks_version';
+        END
+        ''',
+    ]),
+    # Строки с user_id = 0 — сумма по всем пользователям, чтобы общие
+    # запросы читали по строке на (корзину, шаблон), а не на пользователя
+    (8, 'Сводки трафика и наград по часам и дням', [
+        *(f'''
+        CREATE TABLE {table} (
+            user_id INTEGER NOT NULL,
+            bucket TEXT NOT NULL,
+            task_id INTEGER NOT NULL,
+            completions INTEGER NOT NULL DEFAULT 0,
+            reward REAL NOT NULL DEFAULT 0,
+            traffic_mb REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, bucket, task_id)
+        ) WITHOUT ROWID
+        ''' for table in ROLLUP_BUCKETS),
+        backfill_rollups,
+        f'''
+        CREATE TRIGGER rollups_assignments_insert AFTER INSERT ON assignments
+        WHEN NEW.status = 'completed' BEGIN{_rollup_upsert('NEW', '+')}END
+        ''',
+        f'''
+        CREATE TRIGGER rollups_assignments_completed AFTER UPDATE OF status ON assignments
+        WHEN NEW.status = 'completed' AND OLD.status IS NOT 'completed' BEGIN{_rollup_upsert('NEW', '+')}END
+        ''',
+        f'''
+        CREATE TRIGGER rollups_assignments_reopened AFTER UPDATE OF status ON assignments
+        WHEN OLD.status = 'completed' AND NEW.status IS NOT 'completed' BEGIN{_rollup_upsert('OLD', '-')}END
+        ''',
+    ]),
+    # Назначения из очереди (?count=N) выполняются по одному, поэтому срок
+    # каждого отсчитывается от конца предыдущих, а не от времени выдачи
+    (9, 'Срок выполнения назначения с учетом очереди', [
+        'ALTER TABLE assignments ADD COLUMN due_at TIMESTAMP',
+        '''
+        UPDATE assignments
+        SET due_at = datetime(assigned_at, '+' || (visit_duration_sec + wait_duration_sec) || ' seconds')
+        WHERE status = 'assigned'
+        ''',
+        'DROP INDEX idx_assignments_open',
+        "CREATE INDEX idx_assignments_open ON assignments (due_at) WHERE status = 'assigned'",
+    ]),
+    (10, 'Индекс последнего завершения пользователя', [
+        "CREATE INDEX idx_assignments_last_completed "
+        "ON assignments (user_id, completed_at) WHERE status = 'completed'",
+    ]),
+    (11, 'Очередь открытых назначений пользователя по сроку', [
+        "CREATE INDEX idx_assignments_queue "
+        "ON assignments (user_id, due_at, id) WHERE status = 'assigned'",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы"""
+    if get_version(conn) >= LATEST_VERSION:
+        return LATEST_VERSION
+
+    # BEGIN IMMEDIATE берет блокировку записи: параллельный процесс
+    # дождется ее и увидит уже обновленную версию
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_version(conn)
+        for target, _description, steps in MIGRATIONS:
+            if target <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {target}')
+            version = target
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return version
+
@@ -1,47 +0,0 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from datetime import datetime
-
-Base = declarative_base()
-
-class User(Base):
-    __tablename__ = "users"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    device_id = Column(String, unique=True, index=True, nullable=False)
-    balance = Column(Float, default=0.0)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    is_active = Column(Boolean, default=True)
-    
-    # Связь с заданиями
-    assignments = relationship("Assignment", back_populates="user")
-
-class Task(Base):
-    __tablename__ = "tasks"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, default="Посетить сайт")
-    url = Column(String, nullable=False)
-    description = Column(String, default="")
-    visit_duration_sec = Column(Integer, default=30)
-    reward = Column(Float, default=0.10)
-    is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    
-    # Связь с назначениями
-    assignments = relationship("Assignment", back_populates="task")
-
-class Assignment(Base):
-    __tablename__ = "assignments"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    task_id = Column(Integer, ForeignKey("tasks.id"))
-    status = Column(String, default="assigned")  # assigned, completed, expired
-    assigned_at = Column(DateTime, default=datetime.utcnow)
-    completed_at = Column(DateTime, nullable=True)
-    
-    # Связи
-    user = relationship("User", back_populates="assignments")
-    task = relationship("Task", back_populates="assignments")
@@ -0,0 +1,54 @@
+"""Отслеживание активности устройств (last_seen и IP) в памяти"""
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+
+def utc_timestamp() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PresenceTracker:
+    """Последний визит и IP устройств, еще не записанные в БД.
+
+    Запросы только отмечают визит в памяти; ``flush`` записывает накопленное
+    одним ``executemany`` в транзакции писателя. ``last_seen`` никогда не
+    уменьшается, поэтому порядок сбросов из разных процессов не важен.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, device_id: str, ip_address: str):
+        with self._lock:
+            self._pending[device_id] = (ip_address, utc_timestamp())
+
+    def get(self, device_id: str) -> Optional[Tuple[str, str]]:
+        """Возвращает несброшенные ``(ip_address, last_seen)`` устройства"""
+        with self._lock:
+            return self._pending.get(device_id)
+
+    def drain(self) -> List[Tuple[str, str, str]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return [(ip, last_seen, device_id) for device_id, (ip, last_seen) in pending.items()]
+
+    def restore(self, rows: List[Tuple[str, str, str]]):
+        """Возвращает несохраненные строки, не затирая более свежие отметки"""
+        with self._lock:
+            for ip, last_seen, device_id in rows:
+                self._pending.setdefault(device_id, (ip, last_seen))
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def flush_presence(conn, rows: List[Tuple[str, str, str]]) -> int:
+    """Записывает строки ``(ip_address, last_seen, device_id)`` из ``PresenceTracker.drain``"""
+    conn.executemany('''
+        UPDATE users SET ip_address = ?, last_seen = MAX(last_seen, ?)
+        WHERE device_id = ?
+    ''', rows)
+    return len(rows)
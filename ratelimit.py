@@ -0,0 +1,121 @@
+"""Ограничение частоты запросов и сброс нагрузки до обращения к базе
+
+Лимиты — token bucket на ключ (device_id или IP) в памяти процесса: с
+несколькими воркерами каждый считает свою долю запросов. Сброс нагрузки
+отклоняет запросы сразу, пока очередь записи или задержка event loop
+выше порога, — лучше быстрый 503, чем таймауты у всех клиентов.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class TokenBuckets:
+    """Token bucket на каждый ключ: ``rate`` запросов в секунду, запас ``burst``.
+
+    Бакет — пара ``(токены, время обновления)`` в OrderedDict в порядке
+    последнего обращения. Бакет, который простоял дольше ``burst / rate``,
+    снова полон и неотличим от отсутствующего, поэтому такие ключи
+    вытесняются с начала словаря без потери состояния; ``max_keys``
+    ограничивает память при наплыве новых ключей.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100_000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.refill_time = self.burst / rate if rate > 0 else 0
+        self._buckets: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key, now: Optional[float] = None) -> float:
+        """Забирает токен; возвращает 0 или через сколько секунд повторить"""
+        if not self.enabled:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        self._evict(now)
+        return wait
+
+    def _evict(self, now: float):
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        # В начале словаря — самые давние обращения
+        while buckets:
+            key, (_tokens, updated) = next(iter(buckets.items()))
+            if now - updated < self.refill_time:
+                break
+            del buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoadShedder:
+    """Решает, принимать ли запрос, по глубине очереди записи и задержке loop.
+
+    Задержка event loop меряется фоновой задачей: она засыпает на
+    ``interval`` и смотрит, насколько позже проснулась. Пока loop занят,
+    задача не просыпается вовсе, поэтому в расчет идет и время с
+    ожидаемого пробуждения.
+    """
+
+    def __init__(self, max_pending_writes: int = 0, max_loop_lag: float = 0,
+                 pending_writes: Callable[[], int] = lambda: 0, interval: float = 0.1):
+        self.max_pending_writes = max_pending_writes
+        self.max_loop_lag = max_loop_lag
+        self.pending_writes = pending_writes
+        self.interval = interval
+        self._lag = 0.0
+        self._expected = None
+        self._task = None
+
+    def loop_lag(self) -> float:
+        if self._expected is None:
+            return 0.0
+        return max(self._lag, time.monotonic() - self._expected)
+
+    def overloaded(self) -> Optional[str]:
+        """Причина отказа ('write_queue' или 'loop_lag') или None"""
+        if self.max_pending_writes and self.pending_writes() > self.max_pending_writes:
+            return "write_queue"
+        if self.max_loop_lag and self.loop_lag() > self.max_loop_lag:
+            return "loop_lag"
+        return None
+
+    async def _monitor(self):
+        while True:
+            self._expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._lag = max(0.0, time.monotonic() - self._expected)
+
+    def start(self):
+        if self.max_loop_lag and self._task is None:
+            self._task = asyncio.create_task(self._monitor(), name="loop_lag")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._expected = None
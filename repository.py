@@ -0,0 +1,261 @@
+"""SQL приложения: функции ``fn(conn, ...)`` над DB-API соединением sqlite3
+
+Здесь только запросы; проверки, кэши и HTTP-ошибки остаются в main.py.
+Функции выполняются через ``Backend.run``/``Backend.write`` (storage.py)
+и сами транзакции не фиксируют.
+"""
+from typing import List, Optional
+
+from metrics import TimedCursor
+from serialization import dict_row
+from maintenance import compute_stats
+
+ADMIN_USER_COLUMNS = ("device_id", "balance", "total_completed", "total_traffic_mb",
+                      "ip_address", "created_at", "last_seen", "is_active")
+
+
+def find_user(conn, device_id: str):
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('SELECT * FROM users WHERE device_id = ?', (device_id,), name="find_user")
+    return cursor.fetchone()
+
+
+def upsert_user(conn, device_id: str, ip_address: str = None):
+    """Создает пользователя одним запросом и возвращает его строку"""
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        INSERT INTO users (device_id, ip_address) VALUES (?, ?)
+        ON CONFLICT (device_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+        RETURNING *
+    ''', (device_id, ip_address or 'unknown'), name="upsert_user")
+    return cursor.fetchone()
+
+
+def get_or_create_user(conn, device_id: str, ip_address: str = None):
+    # Время визита и IP существующих пользователей обновляет presence
+    return find_user(conn, device_id) or upsert_user(conn, device_id, ip_address)
+
+
+def active_assignments(conn, user_id: int, limit: int) -> list:
+    """Открытые назначения пользователя из начала очереди (по сроку ``due_at``)"""
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        SELECT a.* FROM assignments a
+        WHERE a.user_id = ? AND a.status = 'assigned'
+        ORDER BY a.due_at, a.id LIMIT ?
+    ''', (user_id, limit), name="active_assignments")
+    return cursor.fetchall()
+
+
+def insert_assignments(conn, user_id: int, rows: list) -> List[int]:
+    """Создает назначения одним INSERT; ``rows`` — ``(task_id, url, title,
+    description, visit, wait, reward, ip_address)``. Возвращает id по порядку строк.
+
+    Назначения встают в очередь за открытыми: срок ``due_at`` каждого —
+    конец предыдущего плюс его ``visit + wait``.
+    """
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        SELECT MAX(CURRENT_TIMESTAMP, COALESCE(MAX(due_at), CURRENT_TIMESTAMP))
+        FROM assignments
+        WHERE user_id = ? AND status = 'assigned'
+    ''', (user_id,), name="queue_end")
+    queue_end = cursor.fetchone()[0]
+
+    values, offset = [], 0
+    for row in rows:
+        offset += row[4] + row[5]  # visit + wait
+        values.extend((user_id, *row, queue_end, f'+{offset} seconds'))
+    placeholders = ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime(?, ?))'] * len(rows))
+    cursor.execute(f'''
+        INSERT INTO assignments
+        (user_id, task_id, assigned_url, assigned_title, assigned_description,
+         visit_duration_sec, wait_duration_sec, reward, ip_address, due_at)
+        VALUES {placeholders}
+        RETURNING id
+    ''', values, name="insert_assignments")
+
+    # id выдаются по порядку строк VALUES, порядок RETURNING не гарантирован
+    assignment_ids = sorted(row[0] for row in cursor.fetchall())
+    cursor.execute(
+        'UPDATE users SET active_assignments = active_assignments + ? WHERE id = ?',
+        (len(rows), user_id), name="count_assigned"
+    )
+    return assignment_ids
+
+
+def next_task_delay(conn, user_id: int) -> float:
+    """Сколько секунд осталось ждать после последнего завершения (0 — можно сейчас)"""
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        SELECT MAX(0, strftime('%s', completed_at) + wait_duration_sec - strftime('%s', 'now'))
+        FROM assignments
+        WHERE user_id = ? AND status = 'completed'
+        ORDER BY completed_at DESC LIMIT 1
+    ''', (user_id,), name="next_task_delay")
+    row = cursor.fetchone()
+    return row[0] if row and row[0] is not None else 0
+
+
+def get_assignment(conn, assignment_id: int, user_id: int):
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        SELECT a.* FROM assignments a
+        WHERE a.id = ? AND a.user_id = ?
+    ''', (assignment_id, user_id), name="assignment_by_id")
+    return cursor.fetchone()
+
+
+def complete_assignment(conn, assignment, user_id: int, traffic_used_mb: float,
+                        ip_address: str) -> Optional[tuple]:
+    """Завершает назначение и начисляет награду.
+
+    Возвращает ``(new_balance, total_traffic_mb)`` или None, если параллельный
+    запрос уже сменил статус назначения.
+    """
+    assignment_id, reward, old_status = assignment[0], assignment[8], assignment[11]
+    cursor = conn.cursor(TimedCursor)
+
+    # Условное обновление: статус меняется ровно один раз, даже если
+    # параллельный запрос успел завершить назначение после нашего SELECT
+    cursor.execute('''
+        UPDATE assignments SET
+        status = 'completed',
+        completed_at = CURRENT_TIMESTAMP,
+        traffic_used_mb = ?,
+        ip_address = ?
+        WHERE id = ? AND status = ?
+    ''', (traffic_used_mb, ip_address, assignment_id, old_status), name="complete_assignment")
+    if cursor.rowcount != 1:
+        return None
+
+    # Запись в журнал; UNIQUE(assignment_id) не даст начислить дважды
+    cursor.execute('''
+        INSERT INTO ledger (user_id, assignment_id, kind, reward, traffic_mb)
+        VALUES (?, ?, 'reward', ?, ?)
+    ''', (user_id, assignment_id, reward, traffic_used_mb), name="insert_ledger")
+
+    # Баланс и трафик увеличиваются в SQL, счетчики по статусам — в той же транзакции
+    cursor.execute('''
+        UPDATE users SET
+        balance = balance + ?,
+        total_traffic_mb = total_traffic_mb + ?,
+        total_completed = total_completed + 1,
+        active_assignments = active_assignments - (? = 'assigned'),
+        total_expired = total_expired - (? = 'expired'),
+        last_seen = CURRENT_TIMESTAMP
+        WHERE id = ?
+        RETURNING balance, total_traffic_mb
+    ''', (reward, traffic_used_mb, old_status, old_status, user_id), name="credit_user")
+    return cursor.fetchone()
+
+
+def users_page(conn, limit: int, after: Optional[tuple] = None,
+               active_only: bool = False, since: Optional[str] = None) -> list:
+    """Страница пользователей по убыванию (last_seen, id), начиная после ``after``.
+
+    Строки — словари с ключами ``id`` и ``ADMIN_USER_COLUMNS``.
+    """
+    conditions, params = [], []
+    if after is not None:
+        conditions.append("(last_seen, id) < (?, ?)")
+        params.extend(after)
+    if active_only:
+        conditions.append("is_active = 1")
+    if since is not None:
+        conditions.append("last_seen >= ?")
+        params.append(since)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    cursor = conn.cursor(TimedCursor)
+    cursor.row_factory = dict_row
+    cursor.execute(f'''
+        SELECT id, {", ".join(ADMIN_USER_COLUMNS)}
+        FROM users
+        {where}
+        ORDER BY last_seen DESC, id DESC
+        LIMIT ?
+    ''', (*params, limit), name="admin_users_page")
+    return cursor.fetchall()
+
+
+def read_stats(conn, fresh: bool = False) -> dict:
+    """Агрегаты для /admin/stats; ``fresh`` — полный пересчет по исходным таблицам"""
+    if fresh:
+        return compute_stats(conn)
+
+    # Агрегаты поддерживаются триггерами при каждой записи
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('SELECT key, value FROM stats', name="stats")
+    stats = dict(cursor.fetchall())
+
+    # Активные пользователи (были онлайн последние 24 часа),
+    # по 10-минутным корзинам last_seen
+    cursor.execute('''
+        SELECT COALESCE(SUM(users), 0) FROM activity_buckets
+        WHERE bucket >= substr(datetime('now', '-24 hours'), 1, 15) || '0:00'
+    ''', name="stats_active_users")
+    stats["active_users_24h"] = cursor.fetchone()[0]
+    return stats
+
+
+# Таблицы сводок по гранулярности (см. migrations.ROLLUP_BUCKETS)
+ROLLUP_TABLES = {"hour": "rollups_hourly", "day": "rollups_daily"}
+
+
+def rollup_range(conn, granularity: str, start: str, end: str, user_id: int = 0,
+                 task_id: Optional[int] = None, by_task: bool = False) -> list:
+    """Корзины сводки с ``start`` по ``end`` включительно (строки-корзины).
+
+    ``user_id = 0`` — общие корзины. Строки — ``(bucket, task_id или None,
+    completions, reward, traffic_mb)`` по возрастанию корзины.
+    """
+    conditions, params = ["user_id = ?", "bucket >= ?", "bucket <= ?"], [user_id, start, end]
+    if task_id is not None:
+        conditions.append("task_id = ?")
+        params.append(task_id)
+    group = "bucket, task_id" if by_task else "bucket"
+
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute(f'''
+        SELECT bucket, {"task_id" if by_task else "NULL"},
+               SUM(completions), TOTAL(reward), TOTAL(traffic_mb)
+        FROM {ROLLUP_TABLES[granularity]}
+        WHERE {" AND ".join(conditions)}
+        GROUP BY {group} ORDER BY {group}
+    ''', params, name="analytics_range")
+    return cursor.fetchall()
+
+
+TASK_COLUMNS = ("id", "url_template", "title_template", "description_template", "min_duration",
+                "max_duration", "min_wait", "max_wait", "base_reward", "is_active", "created_at")
+
+
+def insert_task(conn, params: tuple, task_id: Optional[int] = None) -> int:
+    """Добавляет шаблон задания и возвращает его id.
+
+    С ``task_id`` — копия шаблона в другом шарде под тем же id; если такой
+    id уже есть, ничего не меняется.
+    """
+    cursor = conn.cursor(TimedCursor)
+    cursor.execute('''
+        INSERT INTO tasks
+        (id, url_template, title_template, description_template, min_duration,
+         max_duration, min_wait, max_wait, base_reward)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO NOTHING
+    ''', (task_id, *params), name="insert_task")
+    return task_id if task_id is not None else cursor.lastrowid
+
+
+def all_tasks(conn) -> list:
+    return conn.execute(f'SELECT {", ".join(TASK_COLUMNS)} FROM tasks ORDER BY id').fetchall()
+
+
+def copy_missing_tasks(conn, rows: list) -> int:
+    """Добавляет шаблоны из другого шарда (строки ``all_tasks``), которых здесь нет"""
+    placeholders = ", ".join("?" * len(TASK_COLUMNS))
+    return conn.executemany(f'''
+        INSERT INTO tasks ({", ".join(TASK_COLUMNS)}) VALUES ({placeholders})
+        ON CONFLICT (id) DO NOTHING
+    ''', rows).rowcount
@@ -0,0 +1,34 @@
+"""Быстрая сериализация ответов без построения Pydantic-моделей на строку
+
+Строки из своей же базы уже имеют нужные типы, поэтому в быстром режиме
+(``FAST_SERIALIZATION=1``) списочные эндпоинты отдают словари прямо в
+``FastJSONResponse``: FastAPI не валидирует возвращенный ``Response``, а
+схема OpenAPI по-прежнему берется из ``response_model`` маршрута.
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # без orjson — стандартный json
+    orjson = None
+
+
+def dict_row(cursor, row) -> dict:
+    """``row_factory`` sqlite3: строка как словарь по именам колонок"""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse на orjson (если установлен); содержимое не проверяется"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,129 @@
+"""Шардирование данных пользователей по device_id между несколькими файлами SQLite
+
+SQLite пропускает одного писателя на файл, поэтому при ``DB_SHARDS > 1``
+пользователи и их назначения раскладываются по K файлам, у каждого свой
+писатель. Запросы одного устройства идут ровно в один шард; админские
+запросы опрашивают все шарды и сливают результаты. Шаблоны заданий
+копируются во все шарды с одинаковыми id (они меняются редко).
+
+Число шардов фиксируется при развертывании: при смене K устройства
+переедут в другие файлы, а их данные — нет.
+"""
+import asyncio
+import heapq
+import os
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from storage import Backend, open_database
+from task_cache import CompletedTemplates, TemplateCache
+
+
+def shard_urls(url: str, count: int) -> List[str]:
+    """URL файлов шардов: ``tasks.db`` -> ``tasks.shard0.db``, ``tasks.shard1.db``, ..."""
+    if count == 1:
+        return [url]
+    prefix, path = url.split(':///', 1)
+    root, ext = os.path.splitext(path)
+    return [f'{prefix}:///{root}.shard{i}{ext or ".db"}' for i in range(count)]
+
+
+def shard_index(device_id: str, count: int) -> int:
+    """Стабильный между процессами номер шарда (hash() в Python рандомизирован)"""
+    return zlib.crc32(device_id.encode()) % count
+
+
+class Shard:
+    """Бэкенд одного файла и кэши, которые относятся к его строкам.
+
+    id пользователей в разных шардах пересекаются, поэтому кэш выполненных
+    шаблонов у каждого шарда свой; оба кэша используются только из операций
+    записи этого шарда.
+    """
+
+    def __init__(self, index: int, db: Backend, template_cache: TemplateCache,
+                 completed_templates: CompletedTemplates):
+        self.index = index
+        self.db = db
+        self.template_cache = template_cache
+        self.completed_templates = completed_templates
+
+
+class ShardSet:
+    """Набор шардов; при одном шарде ведет себя как обычная база"""
+
+    def __init__(self, shards: Sequence[Shard]):
+        self.shards = list(shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __getitem__(self, index: int) -> Shard:
+        return self.shards[index]
+
+    def for_device(self, device_id: str) -> Shard:
+        return self.shards[shard_index(device_id, len(self.shards))]
+
+    def group(self, items: Iterable, device_id: Callable) -> Dict[Shard, list]:
+        """Раскладывает элементы по шардам их устройств, сохраняя порядок"""
+        groups = defaultdict(list)
+        for item in items:
+            groups[self.for_device(device_id(item))].append(item)
+        return groups
+
+    async def run_all(self, fn, *args) -> list:
+        """Чтение ``fn(conn, *args)`` на всех шардах параллельно, результаты по порядку шардов"""
+        return await asyncio.gather(*(shard.db.run(fn, *args) for shard in self.shards))
+
+    def pending_writes(self) -> int:
+        """Самая длинная очередь записи среди шардов (у каждого свой писатель)"""
+        return max(shard.db.pending_writes() for shard in self.shards)
+
+    def start(self):
+        for shard in self.shards:
+            shard.db.start()
+
+    def close(self):
+        for shard in self.shards:
+            shard.db.close()
+
+
+def open_shards(url: str, count: int, weight_by_reward: bool = False,
+                completed_cache_size: int = 100_000, template_revalidate_interval: float = 1.0,
+                **options) -> ShardSet:
+    """Открывает K бэкендов по ``DATABASE_URL``; ``options`` передаются в ``open_database``"""
+    return ShardSet(
+        Shard(index, open_database(shard_url, **options),
+              TemplateCache(weight_by_reward=weight_by_reward,
+                            revalidate_interval=template_revalidate_interval),
+              CompletedTemplates(capacity=max(1, completed_cache_size // count)))
+        for index, shard_url in enumerate(shard_urls(url, count))
+    )
+
+
+def merge_pages(pages: Sequence[list], limit: int, key: Callable) -> tuple:
+    """Сливает отсортированные по убыванию ``key`` страницы шардов.
+
+    Возвращает ``(строки, позиции)``: первые ``limit`` строк общего порядка
+    и для каждого шарда последнюю взятую из него строку (None — не брали).
+    При равенстве ключей порядок задает номер шарда, поэтому он полный.
+    """
+    merged = heapq.merge(*([(key(row), index, row) for row in page] for index, page in enumerate(pages)),
+                         key=lambda item: item[:2], reverse=True)
+    rows, positions = [], [None] * len(pages)
+    for _key, index, row in merged:
+        if len(rows) == limit:
+            break
+        rows.append(row)
+        positions[index] = row
+    return rows, positions
+
+
+def has_more(pages: Sequence[list], positions: Sequence[Optional[tuple]], limit: int) -> bool:
+    """Остались ли строки после слитой страницы хотя бы в одном шарде"""
+    return any(page and (position is not page[-1] or len(page) == limit)
+               for page, position in zip(pages, positions))
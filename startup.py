@@ -0,0 +1,41 @@
+"""Профиль холодного старта: время фаз от импорта приложения до первого ответа
+
+main.py импортирует этот модуль первым, поэтому фаза ``imports`` включает
+FastAPI и все модули приложения. С ``STARTUP_PROFILE=1`` отчет печатается
+в stderr после первого ответа.
+"""
+import sys
+import time
+
+
+class StartupProfiler:
+    """Фазы старта по порядку: ``mark(name)`` закрывает фазу, начатую предыдущей отметкой"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = []
+        self.done = False
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def finish(self, name: str, started: float, verbose: bool = False):
+        """Последняя фаза — с ``started`` (ожидание клиента не считается);
+        повторные вызовы ничего не делают"""
+        if self.done:
+            return
+        self.done = True
+        self.phases.append((name, time.perf_counter() - started))
+        if verbose:
+            print(self.report(), file=sys.stderr, flush=True)
+
+    def report(self) -> str:
+        total = sum(duration for _, duration in self.phases)
+        lines = [f"{name:20} {duration * 1000:9.1f} мс" for name, duration in self.phases]
+        return "\n".join(["Старт приложения:", *lines, f"{'всего':20} {total * 1000:9.1f} мс"])
+
+
+profiler = StartupProfiler()
@@ -0,0 +1,418 @@
+"""Доступ к SQLite вне event loop: пул соединений для чтения и единственный писатель
+
+Бэкенд выбирается по ``DATABASE_URL`` (см. ``open_database``): встроенный
+``Database`` или ``PooledDatabase``, где соединениями управляет QueuePool
+SQLAlchemy. Оба дают одинаковый интерфейс ``Backend``, а SQL живет в
+repository.py и получает DB-API соединение sqlite3: SQLAlchemy здесь только
+пул, запросы не переводятся на другие диалекты, и поддерживается только SQLite.
+"""
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка действует только внутри процесса
+    fcntl = None
+
+# Настройки, которые нужно выставлять на каждом соединении
+# (journal_mode=WAL сохраняется в самом файле и выставляется в init_db)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+class WriteQueue:
+    """Единственный писатель с групповым коммитом.
+
+    Обработчики передают операции вида ``fn(conn, *args)``; поток писателя
+    собирает все, что пришло в течение ``window`` секунд (но не больше
+    ``max_batch``), выполняет их в одной транзакции и фиксирует ее одним
+    commit. Каждая операция выполняется внутри SAVEPOINT, поэтому ошибка
+    одной операции откатывает только ее. Операции не должны вызывать
+    ``commit`` сами. ``on_commit(длительность, размер группы)`` вызывается
+    после каждого успешного коммита.
+    """
+
+    def __init__(self, connect, window: float = 0.002, max_batch: int = 128, on_commit=None):
+        self._connect = connect
+        self.window = window
+        self.max_batch = max_batch
+        self.on_commit = on_commit
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Дожидается выполнения уже поставленных операций и останавливает поток"""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    async def submit(self, fn, *args):
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, args, loop, future))
+        return await future
+
+    def __len__(self):
+        """Операций в очереди, еще не взятых писателем"""
+        return self._queue.qsize()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Сигнал остановки обработаем после текущей группы
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        conn = self._connect()
+        # Транзакциями управляем сами: BEGIN IMMEDIATE ... COMMIT
+        conn.isolation_level = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                self._commit_group(conn, self._collect(item))
+        finally:
+            conn.close()
+
+    def _commit_group(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, loop, future in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = fn(conn, *args)
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((loop, future, None, exc))
+                else:
+                    conn.execute("RELEASE op")
+                    results.append((loop, future, result, None))
+            started = time.perf_counter()
+            conn.execute("COMMIT")
+            if self.on_commit:
+                self.on_commit(time.perf_counter() - started, len(batch))
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            # Группа не зафиксирована: ошибка достается всем ее участникам
+            results = [(loop, future, None, exc) for _, _, loop, future in batch]
+
+        for loop, future, result, exc in results:
+            loop.call_soon_threadsafe(_resolve, future, result, exc)
+
+
+def _resolve(future, result, exc):
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class FileLock:
+    """Межпроцессная блокировка на файле (flock) для воркеров одной базы"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Берет блокировку; с ``blocking=False`` возвращает False, если она занята"""
+        with self._lock:
+            if self._file is not None:
+                return True
+            f = open(self.path, "a+")
+            try:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                return False
+            self._file = f
+            return True
+
+    def release(self):
+        with self._lock:
+            if self._file is not None:
+                # Закрытие файла снимает flock
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Backend:
+    """Интерфейс хранилища для приложения и фоновых задач.
+
+    ``run(fn, *args)`` — чтение, ``write(fn, *args)`` — запись в транзакции;
+    ``fn(conn, *args)`` получает DB-API соединение sqlite3 и не вызывает
+    ``commit`` сам. ``connection()`` отдает соединение напрямую (миграции),
+    ``path`` — файл базы (для межпроцессных блокировок рядом с ним).
+    """
+
+    path: str
+
+    def connection(self):
+        raise NotImplementedError
+
+    async def run(self, fn, *args):
+        raise NotImplementedError
+
+    async def write(self, fn, *args):
+        raise NotImplementedError
+
+    def pending_writes(self) -> int:
+        """Записей, ожидающих писателя (для сброса нагрузки)"""
+        return 0
+
+    def start(self):
+        pass
+
+    def close(self):
+        raise NotImplementedError
+
+
+class Database(Backend):
+    """Пул соединений SQLite для чтения и очередь записи.
+
+    Обработчики FastAPI не должны вызывать sqlite3 напрямую: любой медленный
+    запрос или commit блокирует весь event loop. Чтения передаются в ``run``
+    как синхронная функция ``fn(conn, *args)`` и выполняются в пуле потоков
+    на соединении из пула. Записи передаются в ``write`` и выполняются
+    единственным писателем с групповым коммитом (см. ``WriteQueue``).
+    В режиме WAL чтения не ждут писателя.
+    """
+
+    def __init__(self, path: str, pool_size: int = 8, busy_timeout: float = 30.0,
+                 commit_window: float = 0.002, max_batch: int = 128,
+                 statement_cache_size: int = 256, on_connect=None, on_commit=None):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout = busy_timeout
+        self.statement_cache_size = statement_cache_size
+        self.on_connect = on_connect
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self.writer = WriteQueue(self._connect, window=commit_window, max_batch=max_batch,
+                                 on_commit=on_commit)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                               cached_statements=self.statement_cache_size)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if self.on_connect:
+            self.on_connect(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Берет соединение из пула (или открывает новое) и возвращает его обратно"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if conn.in_transaction:
+                # Чтения не должны держать открытую транзакцию (снимок WAL)
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _call(self, fn, args):
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    async def run(self, fn, *args):
+        """Выполняет чтение ``fn(conn, *args)`` в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    async def write(self, fn, *args):
+        """Выполняет запись ``fn(conn, *args)`` через единственного писателя"""
+        return await self.writer.submit(fn, *args)
+
+    def pending_writes(self) -> int:
+        return len(self.writer)
+
+    def start(self):
+        self.writer.start()
+
+    def close(self):
+        self.writer.stop()
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class PooledDatabase(Backend):
+    """Пул соединений SQLAlchemy (QueuePool) вместо собственного пула и писателя.
+
+    Соединения — те же соединения драйвера pysqlite, что и у ``Database``;
+    SQL Expression Language и ORM не используются.
+
+    Чтения и записи выполняются в пуле потоков на соединениях движка;
+    каждая запись — отдельная транзакция ``BEGIN IMMEDIATE ... COMMIT``.
+    SQLite допускает одного писателя, поэтому записи процесса ждут друг
+    друга на блокировке, а не в busy handler. Кэш подготовленных запросов —
+    ``cached_statements`` драйвера sqlite3 на каждом соединении пула.
+    """
+
+    def __init__(self, url: str, pool_size: int = 8, max_overflow: int = 4,
+                 busy_timeout: float = 30.0, statement_cache_size: int = 256,
+                 on_connect=None, on_commit=None):
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.engine import make_url
+        from sqlalchemy.pool import QueuePool
+
+        self.url = url
+        self.path = make_url(url).database
+        self.on_connect = on_connect
+        self.on_commit = on_commit
+        self.engine = create_engine(
+            url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+            connect_args={"timeout": busy_timeout, "check_same_thread": False,
+                          "cached_statements": statement_cache_size},
+        )
+        event.listen(self.engine, "connect", self._configure)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size + max_overflow,
+                                            thread_name_prefix="db")
+        self._write_lock = threading.Lock()
+        self._pending = 0
+
+    def _configure(self, conn, record):
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        if self.on_connect:
+            self.on_connect(conn)
+
+    @contextmanager
+    def connection(self):
+        """Берет соединение из пула движка; при возврате пул откатывает транзакцию"""
+        fairy = self.engine.raw_connection()
+        try:
+            yield fairy.driver_connection
+        finally:
+            fairy.close()
+
+    def _read(self, fn, args):
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    def _write(self, fn, args):
+        with self._write_lock, self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                started = time.perf_counter()
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            if self.on_commit:
+                self.on_commit(time.perf_counter() - started, 1)
+            return result
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._read, fn, args)
+
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self._pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, self._write, fn, args)
+        finally:
+            self._pending -= 1
+
+    def pending_writes(self) -> int:
+        return self._pending
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.engine.dispose()
+
+
+def database_path(url: str) -> str:
+    """Путь к файлу из URL SQLite: ``sqlite:///путь`` или ``sqlite+драйвер:///путь``"""
+    scheme, separator, path = url.partition(":///")
+    if not separator or scheme.split("+", 1)[0] != "sqlite":
+        raise ValueError(f"Неподдерживаемая СУБД в DATABASE_URL: {url.split(':', 1)[0]} "
+                         "(поддерживается только SQLite: sqlite:///путь или "
+                         "sqlite+pysqlite:///путь)")
+    return path.split("?", 1)[0]
+
+
+def open_database(url: str, pool_size: int = 8, max_overflow: int = 4,
+                  commit_window: float = 0.002, statement_cache_size: int = 256,
+                  on_connect=None, on_commit=None) -> Backend:
+    """Создает бэкенд по URL.
+
+    ``sqlite:///путь`` — встроенный ``Database``; URL с явным драйвером
+    (``sqlite+pysqlite:///путь``) — ``PooledDatabase`` на SQLAlchemy.
+    SQL репозитория написан на диалекте SQLite, поэтому другие СУБД
+    (например, ``postgres://``, который Render выставляет для подключенной
+    базы) отклоняются ``ValueError`` при старте, а не на первом запросе.
+    """
+    path = database_path(url)
+    if url.startswith("sqlite:///"):
+        return Database(path, pool_size=pool_size,
+                        commit_window=commit_window, statement_cache_size=statement_cache_size,
+                        on_connect=on_connect, on_commit=on_commit)
+    if not url.startswith("sqlite+pysqlite:///"):
+        raise ValueError(f"Неподдерживаемый драйвер в DATABASE_URL: {url.split(':', 1)[0]} "
+                         "(репозиторию нужно DB-API соединение sqlite3)")
+    return PooledDatabase(url, pool_size=pool_size, max_overflow=max_overflow,
+                          statement_cache_size=statement_cache_size,
+                          on_connect=on_connect, on_commit=on_commit)
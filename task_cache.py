@@ -0,0 +1,162 @@
+"""Кэш шаблонов заданий в памяти и выбор шаблона без запросов к БД"""
+import random
+import time
+from collections import OrderedDict
+from typing import Iterable, List, NamedTuple, Optional, Set
+
+
+class TaskTemplate(NamedTuple):
+    id: int
+    url_template: str
+    title_template: str
+    description_template: str
+    min_duration: int
+    max_duration: int
+    min_wait: int
+    max_wait: int
+    base_reward: float
+
+
+TEMPLATE_COLUMNS = ', '.join(TaskTemplate._fields)
+
+
+class AliasSampler:
+    """Взвешенная выборка за O(1) (метод алиасов Уокера/Воуза)"""
+
+    def __init__(self, weights: List[float]):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self) -> int:
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+class TemplateCache:
+    """Активные шаблоны заданий и предрасчитанный семплер.
+
+    Шаблоны меняются только через ``POST /admin/tasks``, поэтому набор
+    загружается один раз и перечитывается после ``invalidate()`` или когда
+    изменилась версия шаблонов в БД (``stats.tasks_version``, ее увеличивают
+    триггеры) — так видны изменения, сделанные другими воркерами. Версия
+    сверяется не чаще раза в ``revalidate_interval`` секунд, в остальное
+    время выбор шаблона не обращается к БД.
+    Если ``weight_by_reward`` включен, вероятность шаблона пропорциональна
+    его ``base_reward``, иначе выбор равномерный.
+    """
+
+    # Сколько раз пробуем отбраковку, прежде чем строить список кандидатов
+    MAX_REJECTIONS = 8
+
+    def __init__(self, weight_by_reward: bool = False, revalidate_interval: float = 1.0):
+        self.weight_by_reward = weight_by_reward
+        self.revalidate_interval = revalidate_interval
+        self.templates: List[TaskTemplate] = []
+        self._sampler: Optional[AliasSampler] = None
+        self._version = None
+        self._stale = True
+        self._checked = 0.0
+
+    def invalidate(self):
+        self._stale = True
+
+    def ensure(self, conn):
+        """Перечитывает шаблоны, если кэш был сброшен или шаблоны изменились"""
+        if self._stale:
+            self.load(conn)
+            return
+        now = time.monotonic()
+        if now - self._checked < self.revalidate_interval:
+            return
+        self._checked = now
+        if _tasks_version(conn) != self._version:
+            self.load(conn)
+
+    def load(self, conn):
+        self._version = _tasks_version(conn)
+        self._checked = time.monotonic()
+        rows = conn.execute(
+            f'SELECT {TEMPLATE_COLUMNS} FROM tasks WHERE is_active = 1 ORDER BY id'
+        ).fetchall()
+        self.templates = [TaskTemplate(*row) for row in rows]
+        self._sampler = AliasSampler(self._weights(self.templates)) if self.templates else None
+        self._stale = False
+
+    def _weights(self, templates: Iterable[TaskTemplate]) -> List[float]:
+        if self.weight_by_reward:
+            return [max(t.base_reward, 0.0) or 1e-6 for t in templates]
+        return [1.0 for _ in templates]
+
+    def choose(self, exclude: Set[int] = frozenset()) -> Optional[TaskTemplate]:
+        """Выбирает шаблон, по возможности не из ``exclude``.
+
+        Если пользователь уже выполнял все шаблоны, выбирается любой.
+        """
+        if not self.templates:
+            return None
+
+        for _ in range(self.MAX_REJECTIONS):
+            template = self.templates[self._sampler.sample()]
+            if template.id not in exclude:
+                return template
+
+        candidates = [t for t in self.templates if t.id not in exclude]
+        if not candidates:
+            return self.templates[self._sampler.sample()]
+        return random.choices(candidates, weights=self._weights(candidates))[0]
+
+
+def _tasks_version(conn):
+    row = conn.execute("SELECT value FROM stats WHERE key = 'tasks_version'").fetchone()
+    return row[0] if row else None
+
+
+class CompletedTemplates:
+    """Множества id шаблонов, уже выполненных пользователем (LRU по user_id).
+
+    Используется только из операций записи, а бэкенд выполняет их по одной,
+    поэтому блокировки не нужны. Завершения в других воркерах сюда не
+    попадают; это только предпочтение при выборе шаблона, а не проверка.
+    """
+
+    def __init__(self, capacity: int = 100_000):
+        self.capacity = capacity
+        self._sets: 'OrderedDict[int, Set[int]]' = OrderedDict()
+
+    def get(self, conn, user_id: int) -> Set[int]:
+        completed = self._sets.get(user_id)
+        if completed is not None:
+            self._sets.move_to_end(user_id)
+            return completed
+
+        rows = conn.execute('''
+            SELECT task_id FROM assignments
+            WHERE user_id = ? AND status = 'completed'
+            UNION
+            SELECT task_id FROM assignments_archive
+            WHERE user_id = ? AND status = 'completed'
+        ''', (user_id, user_id)).fetchall()
+        completed = {row[0] for row in rows}
+        self._sets[user_id] = completed
+        if len(self._sets) > self.capacity:
+            self._sets.popitem(last=False)
+        return completed
+
+    def add(self, user_id: int, task_id: int):
+        completed = self._sets.get(user_id)
+        if completed is not None:
+            completed.add(task_id)
@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py читает окружение при импорте: база по умолчанию — во временном
+# каталоге, все клиенты TestClient приходят с одного адреса
+os.environ.setdefault("TASKS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="tests-"), "tasks.db"))
+os.environ.setdefault("RATE_LIMIT_IP_RPS", "0")
+os.environ.setdefault("RATE_LIMIT_DEVICE_RPS", "0")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "tasks.db")
+
+
+@pytest.fixture
+def conn(db_path):
+    """Соединение с базой последней схемы (с начальными шаблонами заданий)"""
+    from migrations import migrate
+
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def app(db_path, monkeypatch):
+    """Приложение на чистой базе; кэши процесса — новые для каждого теста"""
+    import main
+    from cache import IdempotencyCache, VersionedCache
+    from presence import PresenceTracker
+
+    monkeypatch.setattr(main, "DATABASE_URL", f"sqlite:///{db_path}")
+    monkeypatch.setattr(main, "completions", IdempotencyCache())
+    monkeypatch.setattr(main, "responses", VersionedCache(capacity=main.RESPONSE_CACHE_SIZE,
+                                                          ttl=main.RESPONSE_CACHE_TTL_SEC))
+    monkeypatch.setattr(main, "presence", PresenceTracker())
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app) as client:
+        yield client
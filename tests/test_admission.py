@@ -0,0 +1,65 @@
+import pytest
+
+import main
+from ratelimit import TokenBuckets
+
+
+@pytest.fixture
+def ip_limits(monkeypatch):
+    limits = TokenBuckets(rate=1, burst=2)
+    monkeypatch.setattr(main, "ip_limits", limits)
+    return limits
+
+
+def spoofed(client, count: int) -> list:
+    return [client.get("/", headers={"x-forwarded-for": f"10.0.0.{i}"}).status_code
+            for i in range(count)]
+
+
+def test_ip_limit_ignores_client_supplied_forwarded_for(client, ip_limits):
+    assert spoofed(client, 4) == [200, 200, 429, 429]
+    assert len(ip_limits) == 1
+
+
+def test_ip_limit_uses_hop_appended_by_trusted_proxy(client, ip_limits, monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 1)
+    codes = [client.get("/", headers={"x-forwarded-for": f"10.0.0.{i}, 203.0.113.7"}).status_code
+             for i in range(4)]
+    assert codes == [200, 200, 429, 429]
+    assert list(ip_limits._buckets) == ["203.0.113.7"]
+
+
+def test_overload_rejects_everything_but_metrics(client, monkeypatch):
+    # Объект тот же, что запустил lifespan: его задача остановится при выходе
+    monkeypatch.setattr(main.shedder, "max_pending_writes", 1)
+    monkeypatch.setattr(main.shedder, "pending_writes", lambda: 10)
+    response = client.get("/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    assert 'route="unmatched",status="503"' in metrics.text
+
+
+def test_rejections_carry_cors_headers(client, ip_limits, monkeypatch):
+    origin = {"origin": "https://app.example.com"}
+    assert [client.get("/", headers=origin).status_code for _ in range(3)] == [200, 200, 429]
+    assert "access-control-allow-origin" in client.get("/", headers=origin).headers
+
+    monkeypatch.setattr(main.shedder, "max_pending_writes", 1)
+    monkeypatch.setattr(main.shedder, "pending_writes", lambda: 10)
+    response = client.get("/", headers=origin)
+    assert response.status_code == 503
+    assert "access-control-allow-origin" in response.headers
+
+
+def test_device_limit_returns_retry_after(client, monkeypatch):
+    monkeypatch.setattr(main, "device_limits", TokenBuckets(rate=0.5, burst=1))
+    assert client.get("/get-task/dev-1").status_code == 200
+    response = client.get("/get-task/dev-1")
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "2"
+    # Лимит — на устройство, другие не затронуты
+    assert client.get("/get-task/dev-2").status_code == 200
+    assert 'reason="device"' in client.get("/metrics").text
@@ -0,0 +1,49 @@
+import asyncio
+import os
+
+import httpx
+
+import bench
+
+
+async def respond(status_code: int):
+    return httpx.Response(status_code)
+
+
+async def fail():
+    raise httpx.ConnectError("refused")
+
+
+def test_only_successful_responses_count_towards_latency():
+    recorder = bench.Recorder()
+
+    async def scenario():
+        for status_code in (200, 200, 429, 503, 500, 404):
+            await recorder.call("GET /x", respond(status_code))
+        await recorder.call("GET /x", fail())
+
+    asyncio.run(scenario())
+    result = bench.summarize(recorder, elapsed=1.0)
+    endpoint = result["endpoints"]["GET /x"]
+    assert endpoint["requests"] == 2
+    assert endpoint["throughput_rps"] == 2
+    assert endpoint["errors"] == 5
+    assert endpoint["rejected"] == 2
+    assert result["error_rate"] == round(5 / 7, 4)
+
+
+def test_error_rate_fails_the_run(monkeypatch):
+    async def run_in_process(args):
+        recorder = bench.Recorder()
+        await recorder.call("GET /x", respond(200))
+        await recorder.call("GET /x", respond(429))
+        return dict(bench.summarize(recorder, elapsed=1.0), cpu_sec=0.0)
+
+    # main() дописывает настройки прогона в окружение процесса
+    monkeypatch.setattr(os, "environ", dict(os.environ))
+    monkeypatch.setattr(bench, "seed_database", lambda *args, **kwargs: None)
+    monkeypatch.setattr(bench, "run_in_process", run_in_process)
+    monkeypatch.setattr(bench, "check_shards", lambda path, shards: [])
+    argv = ["--output", "/dev/null"]
+    assert bench.main(argv) == 1
+    assert bench.main(argv + ["--max-error-rate", "0.5"]) == 0
@@ -0,0 +1,157 @@
+"""Основные эндпоинты на обоих бэкендах хранилища (см. storage.open_database)"""
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from storage import Database, PooledDatabase, open_database
+
+
+@pytest.fixture(params=[("sqlite", Database), ("sqlite+pysqlite", PooledDatabase)],
+                ids=["sqlite", "sqlite+pysqlite"])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def app(backend, db_path, app, monkeypatch):
+    monkeypatch.setattr(main, "DATABASE_URL", f"{backend[0]}:///{db_path}")
+    return app
+
+
+def get_task(client, device_id, **params):
+    response = client.get(f"/get-task/{device_id}", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def complete(client, device_id, assignment_id, **headers):
+    return client.post("/complete-task", headers=headers,
+                       json={"device_id": device_id, "assignment_id": assignment_id,
+                             "traffic_used_mb": 5})
+
+
+def test_task_cycle(client, backend):
+    assert isinstance(main.shards[0].db, backend[1])
+
+    assignment = get_task(client, "dev-1")
+    # Пока назначение открыто, выдается оно же
+    assert get_task(client, "dev-1")["assignment_id"] == assignment["assignment_id"]
+
+    response = complete(client, "dev-1", assignment["assignment_id"])
+    assert response.status_code == 200
+    assert response.json()["new_balance"] == assignment["reward"]
+    # Повтор получает тот же ответ, награда не начисляется дважды
+    assert complete(client, "dev-1", assignment["assignment_id"]).json() == response.json()
+
+    user = client.get("/user/dev-1").json()
+    assert user["balance"] == assignment["reward"]
+    assert user["total_completed"] == 1
+    assert user["total_traffic_mb"] == 5
+
+
+def test_idempotency_key_and_batch(client):
+    queue = get_task(client, "dev-1", count=3)
+    assert len(queue) == 3
+    first, second, third = (item["assignment_id"] for item in queue)
+
+    assert complete(client, "dev-1", first, **{"Idempotency-Key": "k1"}).status_code == 200
+    assert complete(client, "dev-1", second, **{"Idempotency-Key": "k1"}).status_code == 422
+
+    response = client.post("/complete-tasks", json=[
+        {"device_id": "dev-1", "assignment_id": first},
+        {"device_id": "dev-1", "assignment_id": second},
+        {"device_id": "dev-1", "assignment_id": 10_000},
+    ])
+    assert [item["status_code"] for item in response.json()] == [200, 200, 404]
+    assert complete(client, "dev-1", third).status_code == 200
+    assert client.get("/user/dev-1").json()["total_completed"] == 3
+
+
+def test_admin_endpoints(client):
+    for device_id in ("dev-1", "dev-2", "dev-3"):
+        assignment = get_task(client, device_id)
+        complete(client, device_id, assignment["assignment_id"])
+
+    page = client.get("/admin/users", params={"limit": 2})
+    assert len(page.json()) == 2
+    rest = client.get("/admin/users", params={"limit": 2, "cursor": page.headers["x-next-cursor"]})
+    assert {user["device_id"] for user in page.json() + rest.json()} == {"dev-1", "dev-2", "dev-3"}
+
+    stats = client.get("/admin/stats").json()
+    assert stats["total_users"] == 3
+    assert stats["total_completed_assignments"] == 3
+    assert client.get("/admin/stats", params={"fresh": True}).json() == stats
+
+    export = client.get("/admin/users/export").text.splitlines()
+    assert len(export) == 3
+
+    created = client.post("/admin/tasks", params={"url_template": "https://example.com/{keyword}"})
+    assert client.get("/admin/stats").json()["active_tasks"] == stats["active_tasks"] + 1
+    assert created.json()["task_id"]
+
+
+def test_analytics_buckets(client, db_path):
+    for device_id, count in (("dev-1", 2), ("dev-2", 3)):
+        for assignment in get_task(client, device_id, count=count):
+            assert complete(client, device_id, assignment["assignment_id"]).status_code == 200
+
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''
+        SELECT u.device_id, a.task_id, a.reward, a.traffic_used_mb, a.completed_at
+        FROM assignments a JOIN users u ON u.id = a.user_id WHERE a.status = 'completed'
+    ''').fetchall()
+    conn.close()
+    assert len(rows) == 5
+
+    def expected(rows, key):
+        totals = {}
+        for row in rows:
+            total = totals.setdefault(key(row), {"completions": 0, "reward": 0.0, "traffic_mb": 0.0})
+            total["completions"] += 1
+            total["reward"] += row[2]
+            total["traffic_mb"] += row[3]
+        return [{**bucket, "completions": total["completions"], "reward": round(total["reward"], 2),
+                 "traffic_mb": round(total["traffic_mb"], 2)}
+                for bucket, total in ((dict(key), total) for key, total in sorted(totals.items()))]
+
+    day = lambda row: (("bucket", row[4][:10]),)
+    hour = lambda row: (("bucket", row[4][:13] + ":00:00"),)
+    analytics = client.get("/admin/analytics", params={"granularity": "day"}).json()
+    assert analytics["granularity"] == "day"
+    assert analytics["buckets"] == expected(rows, day)
+    assert client.get("/admin/analytics").json()["buckets"] == expected(rows, hour)
+
+    by_task = client.get("/admin/analytics", params={"granularity": "day", "group_by": "task"}).json()
+    assert by_task["buckets"] == expected(rows, lambda row: (*day(row), ("task_id", row[1])))
+
+    # Корзины одного устройства — из его строк сводки, а не общих
+    own = [row for row in rows if row[0] == "dev-1"]
+    response = client.get("/admin/analytics", params={"granularity": "day", "device_id": "dev-1"})
+    assert response.json()["buckets"] == expected(own, day)
+    assert client.get("/admin/analytics", params={"device_id": "dev-404"}).status_code == 404
+
+
+@pytest.mark.parametrize("url", ["postgres://user@host/db", "sqlite+aiosqlite:///tasks.db"])
+def test_unsupported_database_url_is_rejected(url):
+    with pytest.raises(ValueError, match="DATABASE_URL"):
+        open_database(url)
+
+
+def test_app_refuses_to_start_on_postgres(monkeypatch):
+    monkeypatch.setattr(main, "DATABASE_URL", "postgres://user@host/db")
+    with pytest.raises(ValueError, match="postgres"):
+        with TestClient(main.app):
+            pass
+
+
+def test_task_queue_extends_in_fifo_order(client):
+    head = [item["assignment_id"] for item in get_task(client, "dev-1", count=2)]
+    queue = get_task(client, "dev-1", count=4)
+    ids = [item["assignment_id"] for item in queue]
+    # Открытые — с начала очереди, новые — в ее конце
+    assert ids[:2] == head
+    assert ids == sorted(ids)
+    assert len(set(ids)) == 4
+    assert [item["assignment_id"] for item in get_task(client, "dev-1", count=4)] == ids
@@ -0,0 +1,97 @@
+"""Push-уведомления: EventHub, TimerQueue и поток /events (events.py)"""
+import asyncio
+import json
+
+import main
+from events import EventHub, TimerQueue, format_event
+
+
+def parse(message):
+    event, data = message.strip().split("\n")
+    return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_hub_drops_oldest_message_on_overflow():
+    hub = EventHub(queue_size=2)
+    queue = hub.subscribe("dev-1")
+    other = hub.subscribe("dev-2")
+    for balance in (1, 2, 3):
+        hub.publish("dev-1", "balance", {"balance": balance})
+
+    assert [queue.get_nowait() for _ in range(queue.qsize())] == [
+        format_event("balance", {"balance": 2}), format_event("balance", {"balance": 3})]
+    assert other.empty()
+
+    hub.unsubscribe("dev-1", queue)
+    assert not hub.is_subscribed("dev-1")
+    assert len(hub) == 1
+
+
+def test_timers_fire_in_order_and_honor_reschedule_and_cancel():
+    async def scenario():
+        timers = TimerQueue()
+        timers.start()
+        fired, done = [], asyncio.Event()
+
+        def callback(name):
+            async def fire():
+                fired.append(name)
+                if name == "last":
+                    done.set()
+            return fire
+
+        timers.schedule("a", 0.2, callback("a-old"))
+        timers.schedule("b", 0.02, callback("b"))
+        timers.schedule("c", 0.03, callback("c"))
+        # Повторный schedule заменяет таймер, в том числе на более ранний
+        timers.schedule("a", 0.01, callback("a"))
+        timers.cancel("c")
+        timers.schedule("last", 0.1, callback("last"))
+        assert len(timers) == 3
+
+        await asyncio.wait_for(done.wait(), 1)
+        await asyncio.sleep(0.15)
+        await timers.stop()
+        assert fired == ["a", "b", "last"]
+        assert len(timers) == 0
+
+    asyncio.run(scenario())
+
+
+def test_timers_rebuild_heap_of_cancelled_entries():
+    timers = TimerQueue()
+
+    async def noop():
+        pass
+
+    for _ in range(500):
+        timers.schedule("dev-1", 60, noop)
+    timers.schedule("dev-2", 60, noop)
+    assert len(timers) == 2
+    # Отмененные записи не копятся без предела
+    assert len(timers._heap) <= 2 * len(timers) + 65
+    assert sorted(entry[2] for entry in timers._heap if entry[3] is not None) == ["dev-1", "dev-2"]
+
+
+def test_event_stream_pushes_balance_and_cleans_up(client):
+    stream = main._event_stream("dev-1", "1.2.3.4")
+    event, data = parse(client.portal.call(stream.__anext__))
+    assert (event, data) == ("balance", {"balance": 0, "total_traffic_mb": 0})
+    event, assignment = parse(client.portal.call(stream.__anext__))
+    assert event == "assignment"
+    assert main.hub.is_subscribed("dev-1")
+
+    response = client.post("/complete-task", json={"device_id": "dev-1", "traffic_used_mb": 5,
+                                                   "assignment_id": assignment["assignment_id"]})
+    assert response.status_code == 200
+    event, data = parse(client.portal.call(stream.__anext__))
+    assert event == "balance"
+    assert data == {"balance": assignment["reward"], "total_traffic_mb": 5,
+                    "reward_added": assignment["reward"]}
+    # Следующее задание придет по таймеру, когда истечет ожидание
+    assert len(main.timers) == 1
+
+    # Клиент отключился: подписка и таймер снимаются
+    client.portal.call(stream.aclose)
+    assert not main.hub.is_subscribed("dev-1")
+    assert len(main.timers) == 0
@@ -0,0 +1,60 @@
+import main
+import repository
+from maintenance import expire_assignments
+
+ROW = (1, "https://example.com", "t", "d", 100, 200, 0.1, "127.0.0.1")  # visit + wait = 300 с
+
+
+def age(conn, seconds: int):
+    """Сдвигает назначения и их сроки в прошлое"""
+    conn.execute("UPDATE assignments SET assigned_at = datetime(assigned_at, ?), "
+                 "due_at = datetime(due_at, ?)", (f"-{seconds} seconds",) * 2)
+
+
+def statuses(conn) -> list:
+    return [row[0] for row in conn.execute("SELECT status FROM assignments ORDER BY id")]
+
+
+def test_queue_deadlines_follow_queue_position(conn):
+    user = repository.upsert_user(conn, "dev-1")
+    repository.insert_assignments(conn, user[0], [ROW] * 3)
+    # Вторая очередь встает за первой
+    repository.insert_assignments(conn, user[0], [ROW])
+    offsets = [row[0] for row in conn.execute(
+        "SELECT CAST(strftime('%s', due_at) - strftime('%s', assigned_at) AS INTEGER) "
+        "FROM assignments ORDER BY id")]
+    assert offsets == [300, 600, 900, 1200]
+
+    # Через 300 + grace истекло только первое назначение очереди
+    age(conn, 301 + 60)
+    assert expire_assignments(conn, grace_sec=60) == 1
+    assert statuses(conn) == ["expired", "assigned", "assigned", "assigned"]
+
+
+def test_expired_assignment_is_not_paid(client):
+    assignment = client.get("/get-task/dev-1").json()
+    with main.shards.for_device("dev-1").db.connection() as conn:
+        conn.execute("UPDATE assignments SET status = 'expired'")
+        conn.commit()
+
+    response = client.post("/complete-task", json={"device_id": "dev-1",
+                                                   "assignment_id": assignment["assignment_id"]})
+    assert response.status_code == 410
+    assert client.get("/user/dev-1").json()["balance"] == 0
+
+
+def test_open_queue_is_served_from_its_head(client):
+    queue = [item["assignment_id"] for item in client.get("/get-task/dev-1",
+                                                          params={"count": 3}).json()]
+    assert queue == sorted(queue)
+    # Одно задание и повтор очереди — с начала, в порядке сроков
+    assert client.get("/get-task/dev-1").json()["assignment_id"] == queue[0]
+    assert [item["assignment_id"] for item in client.get("/get-task/dev-1",
+                                                         params={"count": 3}).json()] == queue
+
+    with main.shards.for_device("dev-1").db.connection() as conn:
+        user = repository.find_user(conn, "dev-1")
+        due = [row[14] for row in repository.active_assignments(conn, user[0], 3)]
+        _, active, _ = main._event_state(conn, "dev-1")
+    assert due == sorted(due)
+    assert active[0] == queue[0]
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from cache import IdempotencyCache
+
+
+def test_cancelled_first_request_still_stores_result():
+    async def scenario():
+        cache = IdempotencyCache()
+        calls = []
+
+        async def write():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.create_task(cache.run("key", write))
+        await asyncio.sleep(0.01)
+        retry = asyncio.create_task(cache.run("key", write))
+        await asyncio.sleep(0.01)
+        # Клиент первого запроса отключился, пока шла запись
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        assert await retry == ("done", "inflight")
+        assert await cache.run("key", write) == ("done", "hit")
+        assert calls == [1]
+
+    asyncio.run(scenario())
+
+
+def test_errors_are_shared_but_not_cached():
+    async def scenario():
+        cache = IdempotencyCache()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("conflict")
+
+        results = await asyncio.gather(cache.run("key", fail), cache.run("key", fail),
+                                       return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError, ValueError]
+
+        async def succeed():
+            return "done"
+
+        assert await cache.run("key", succeed) == ("done", "miss")
+
+    asyncio.run(scenario())
@@ -0,0 +1,28 @@
+import os
+import sqlite3
+
+import maintenance
+
+
+def test_cli_runs_on_every_shard_of_database_url(tmp_path, monkeypatch, capsys):
+    url = f"sqlite+pysqlite:///{tmp_path / 'tasks.db'}"
+    monkeypatch.setattr(maintenance, "DATABASE_URL", url)
+    assert maintenance.main(["--shards", "2", "reconcile"]) == 0
+    assert os.path.exists(tmp_path / "tasks.shard0.db")
+    assert os.path.exists(tmp_path / "tasks.shard1.db")
+
+    # Расхождение только во втором шарде тоже находится
+    conn = sqlite3.connect(tmp_path / "tasks.shard1.db")
+    conn.execute("INSERT INTO users (device_id, total_completed) VALUES ('dev-1', 3)")
+    conn.commit()
+    conn.close()
+    capsys.readouterr()
+    assert maintenance.main(["--shards", "2", "reconcile"]) == 1
+    assert "dev-1: total_completed = 3" in capsys.readouterr().out
+
+
+def test_cli_db_overrides_database_url(tmp_path, monkeypatch):
+    monkeypatch.setattr(maintenance, "DATABASE_URL", f"sqlite:///{tmp_path / 'other.db'}")
+    assert maintenance.main(["--db", str(tmp_path / "tasks.db"), "--shards", "1", "expire"]) == 0
+    assert os.path.exists(tmp_path / "tasks.db")
+    assert not os.path.exists(tmp_path / "other.db")
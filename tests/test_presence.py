@@ -0,0 +1,90 @@
+"""Активность устройств: отметки в памяти и их сброс в БД (presence.py)"""
+import sqlite3
+
+import pytest
+
+import main
+from presence import PresenceTracker, flush_presence
+
+
+def user_row(db_path, device_id):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute("SELECT ip_address, last_seen FROM users WHERE device_id = ?",
+                       (device_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def age_user(db_path, device_id, last_seen="2000-01-01 00:00:00"):
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE users SET ip_address = 'old', last_seen = ? WHERE device_id = ?",
+                 (last_seen, device_id))
+    conn.commit()
+    conn.close()
+
+
+def test_flush_keeps_latest_last_seen(conn):
+    conn.executemany("INSERT INTO users (device_id, last_seen) VALUES (?, ?)",
+                     [("dev-1", "2030-01-01 00:00:00"), ("dev-2", "2020-01-01 00:00:00")])
+    assert flush_presence(conn, [("1.1.1.1", "2025-01-01 00:00:00", "dev-1"),
+                                 ("2.2.2.2", "2025-01-01 00:00:00", "dev-2")]) == 2
+    rows = conn.execute("SELECT device_id, ip_address, last_seen FROM users ORDER BY device_id")
+    # Запоздавший сброс не откатывает last_seen назад
+    assert rows.fetchall() == [("dev-1", "1.1.1.1", "2030-01-01 00:00:00"),
+                               ("dev-2", "2.2.2.2", "2025-01-01 00:00:00")]
+
+
+def test_restore_does_not_overwrite_newer_touch():
+    presence = PresenceTracker()
+    presence.touch("dev-1", "1.1.1.1")
+    presence.touch("dev-2", "2.2.2.2")
+    rows = presence.drain()
+    assert len(presence) == 0
+
+    presence.touch("dev-1", "3.3.3.3")
+    presence.restore(rows)
+    assert presence.get("dev-1")[0] == "3.3.3.3"
+    assert presence.get("dev-2")[0] == "2.2.2.2"
+
+
+def test_user_reads_are_flushed_by_the_job(client, db_path):
+    assert client.get("/user/dev-1").status_code == 200
+    age_user(db_path, "dev-1")
+    main.presence.drain()
+    assert client.get("/admin/stats").json()["active_users_24h"] == 0
+
+    # Чтение только отмечает визит в памяти
+    user = client.get("/user/dev-1").json()
+    assert user["last_seen"] != "2000-01-01 00:00:00"
+    assert user_row(db_path, "dev-1") == ("old", "2000-01-01 00:00:00")
+    assert client.get("/admin/stats").json()["active_users_24h"] == 0
+
+    client.portal.call(main.flush_presence_job)
+    ip_address, last_seen = user_row(db_path, "dev-1")
+    assert ip_address == "testclient"
+    assert last_seen > "2000-01-01 00:00:00"
+    assert len(main.presence) == 0
+    assert client.get("/admin/stats").json()["active_users_24h"] == 1
+
+
+def test_failed_flush_returns_rows_to_pending(client, db_path, monkeypatch):
+    assert client.get("/user/dev-1").status_code == 200
+    age_user(db_path, "dev-1")
+    pending = main.presence.get("dev-1")
+
+    db, failures = main.shards[0].db, [sqlite3.OperationalError("database is locked")]
+    write = db.write
+
+    async def flaky_write(*args):
+        if failures:
+            raise failures.pop()
+        return await write(*args)
+
+    monkeypatch.setattr(db, "write", flaky_write)
+    with pytest.raises(sqlite3.OperationalError):
+        client.portal.call(main.flush_presence_job)
+    assert main.presence.get("dev-1") == pending
+    assert user_row(db_path, "dev-1") == ("old", "2000-01-01 00:00:00")
+
+    client.portal.call(main.flush_presence_job)
+    assert user_row(db_path, "dev-1") == ("testclient", pending[1])
@@ -0,0 +1,101 @@
+"""Планы запросов, которые реально выполняют функции репозитория.
+
+Запросы перехватываются ``set_trace_callback`` (с подставленными
+параметрами), для каждого строится EXPLAIN QUERY PLAN: таблица не должна
+читаться целиком без индекса.
+"""
+import pytest
+
+import repository
+from maintenance import expire_assignments
+from task_cache import CompletedTemplates, TemplateCache
+
+# Таблицы, которые читаются целиком намеренно: несколько строк агрегатов и шаблонов
+SMALL_TABLES = ("stats", "tasks")
+
+
+@pytest.fixture
+def user_id(conn):
+    user = repository.upsert_user(conn, "dev-1", "127.0.0.1")
+    rows = [(1, "https://example.com", "t", "d", 10, 20, 0.1, "127.0.0.1")] * 3
+    first, *_ = repository.insert_assignments(conn, user[0], rows)
+    assignment = repository.get_assignment(conn, first, user[0])
+    repository.complete_assignment(conn, assignment, user[0], 5.0, "127.0.0.1")
+    conn.commit()
+    return user[0]
+
+
+def full_scans(conn, sql: str, allowed=()) -> list:
+    """Строки плана, в которых таблица читается целиком без индекса"""
+    params = (None,) * sql.count("?")
+    scans = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+        detail = row[3]
+        if detail.startswith("SCAN ") and "INDEX" not in detail and detail.split()[1] not in allowed:
+            scans.append(detail)
+    return scans
+
+
+def statements(conn, call) -> list:
+    executed = []
+    conn.set_trace_callback(executed.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    # Запросы триггеров приходят как комментарии "-- TRIGGER ..."
+    return [sql for sql in executed if not sql.lstrip().startswith("--")]
+
+
+CALLS = {
+    "find_user": lambda conn, user_id: repository.find_user(conn, "dev-1"),
+    "upsert_user": lambda conn, user_id: repository.upsert_user(conn, "dev-2"),
+    "active_assignments": lambda conn, user_id: repository.active_assignments(conn, user_id, 5),
+    "insert_assignments": lambda conn, user_id: repository.insert_assignments(
+        conn, user_id, [(2, "https://example.com", "t", "d", 10, 20, 0.1, "127.0.0.1")]),
+    "next_task_delay": lambda conn, user_id: repository.next_task_delay(conn, user_id),
+    "get_assignment": lambda conn, user_id: repository.get_assignment(conn, 2, user_id),
+    "complete_assignment": lambda conn, user_id: repository.complete_assignment(
+        conn, repository.get_assignment(conn, 2, user_id), user_id, 5.0, "127.0.0.1"),
+    "completed_templates": lambda conn, user_id: CompletedTemplates().get(conn, user_id),
+    "template_cache": lambda conn, user_id: TemplateCache().ensure(conn),
+    "users_page": lambda conn, user_id: repository.users_page(conn, 100),
+    "users_page_after": lambda conn, user_id: repository.users_page(
+        conn, 100, after=("2030-01-01 00:00:00", 10)),
+    "users_page_active": lambda conn, user_id: repository.users_page(conn, 100, active_only=True),
+    "users_page_since": lambda conn, user_id: repository.users_page(
+        conn, 100, since="2020-01-01 00:00:00"),
+    "users_page_all_filters": lambda conn, user_id: repository.users_page(
+        conn, 100, after=("2030-01-01 00:00:00", 10), active_only=True,
+        since="2020-01-01 00:00:00"),
+    "read_stats": lambda conn, user_id: repository.read_stats(conn),
+    "rollup_range_hour": lambda conn, user_id: repository.rollup_range(
+        conn, "hour", "2020-01-01 00:00", "2030-01-01 00:00"),
+    "rollup_range_day_by_task": lambda conn, user_id: repository.rollup_range(
+        conn, "day", "2020-01-01", "2030-01-01", by_task=True),
+    "rollup_range_user_task": lambda conn, user_id: repository.rollup_range(
+        conn, "hour", "2020-01-01 00:00", "2030-01-01 00:00", user_id=user_id, task_id=1),
+    "expire_assignments": lambda conn, user_id: expire_assignments(conn, 600, 100),
+}
+
+
+@pytest.mark.parametrize("name", CALLS)
+def test_hot_query_uses_indexes(conn, user_id, name):
+    executed = statements(conn, lambda: CALLS[name](conn, user_id))
+    assert executed
+    scans = {sql: found for sql in executed if (found := full_scans(conn, sql, SMALL_TABLES))}
+    assert scans == {}
+
+
+def test_next_task_delay_orders_by_index(conn, user_id):
+    executed = statements(conn, lambda: repository.next_task_delay(conn, user_id))
+    plan = [row[3] for sql in executed for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+    assert not [detail for detail in plan if "TEMP B-TREE" in detail]
+
+
+def test_next_task_delay_uses_latest_completion(conn, user_id):
+    # Раньше выданное назначение завершено позже: ждать считается от него
+    conn.execute("UPDATE assignments SET status = 'completed', wait_duration_sec = 1000, "
+                 "completed_at = CASE id WHEN 1 THEN datetime('now') "
+                 "ELSE datetime('now', '-1 hour') END")
+    assert 990 <= repository.next_task_delay(conn, user_id) <= 1000
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+from cache import VersionedCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def response_cache_size(**env) -> int:
+    environ = {key: value for key, value in os.environ.items()
+               if key not in ("RESPONSE_CACHE_SIZE", "WEB_CONCURRENCY")}
+    output = subprocess.check_output(
+        [sys.executable, "-c", "import config; print(config.RESPONSE_CACHE_SIZE)"],
+        cwd=ROOT, env=dict(environ, **env), text=True)
+    return int(output)
+
+
+@pytest.mark.parametrize("env, expected", [
+    # uvicorn main:app --workers 4 не сообщает приложению число процессов
+    ({}, 0),
+    ({"RESPONSE_CACHE_SIZE": "100"}, 100),
+    ({"RESPONSE_CACHE_SIZE": "100", "WEB_CONCURRENCY": "4"}, 0),
+])
+def test_response_cache_is_opt_in(env, expected):
+    assert response_cache_size(**env) == expected
+
+
+def test_cached_user_is_revalidated_after_completion(client, monkeypatch):
+    monkeypatch.setattr(main, "responses", VersionedCache(capacity=100, ttl=60))
+    first = client.get("/user/dev-1")
+    etag = first.headers["etag"]
+    assert client.get("/user/dev-1", headers={"if-none-match": etag}).status_code == 304
+
+    assignment = client.get("/get-task/dev-1").json()
+    client.post("/complete-task", json={"device_id": "dev-1",
+                                        "assignment_id": assignment["assignment_id"]})
+    fresh = client.get("/user/dev-1", headers={"if-none-match": etag})
+    assert fresh.status_code == 200
+    assert fresh.json()["balance"] == assignment["reward"]
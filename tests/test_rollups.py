@@ -0,0 +1,47 @@
+"""Сводки rollups_* (миграция 8): триггеры и backfill_rollups дают одно и то же"""
+from migrations import backfill_rollups
+from maintenance import reconcile_rollups
+
+
+def rollups(conn):
+    return {table: conn.execute(f'SELECT * FROM {table} ORDER BY user_id, bucket, task_id').fetchall()
+            for table in ("rollups_hourly", "rollups_daily")}
+
+
+def test_backfill_matches_triggers_and_reconcile(conn):
+    conn.executemany("INSERT INTO users (device_id) VALUES (?)", [("dev-1",), ("dev-2",)])
+    task_id = conn.execute("SELECT id FROM tasks LIMIT 1").fetchone()[0]
+    for user_id, completed_at, reward in ((1, '2024-01-01 10:15:00', 1.5), (1, '2024-01-01 11:05:00', 2.0),
+                                          (2, '2024-01-01 10:45:00', 0.25), (2, '2024-01-02 00:00:00', 3.0)):
+        conn.execute('''
+            INSERT INTO assignments (user_id, task_id, assigned_url, assigned_title, assigned_description,
+                                     visit_duration_sec, wait_duration_sec, reward, status, assigned_at)
+            VALUES (?, ?, 'u', 't', 'd', 10, 10, ?, 'assigned', ?)
+        ''', (user_id, task_id, reward, completed_at))
+        conn.execute('''
+            UPDATE assignments SET status = 'completed', completed_at = ?, traffic_used_mb = 5
+            WHERE id = last_insert_rowid()
+        ''', (completed_at,))
+    # Открытое назначение в сводки не входит
+    conn.execute('''
+        INSERT INTO assignments (user_id, task_id, assigned_url, assigned_title, assigned_description,
+                                 visit_duration_sec, wait_duration_sec, reward, status)
+        VALUES (1, ?, 'u', 't', 'd', 10, 10, 9.0, 'assigned')
+    ''', (task_id,))
+    conn.commit()
+
+    assert reconcile_rollups(conn) == []
+    from_triggers = rollups(conn)
+    assert [row[1:] for row in from_triggers["rollups_daily"] if row[0] == 0] == [
+        ('2024-01-01', task_id, 3, 3.75, 15.0), ('2024-01-02', task_id, 1, 3.0, 5.0)]
+
+    backfill_rollups(conn)
+    assert rollups(conn) == from_triggers
+    assert reconcile_rollups(conn) == []
+
+    # С since пересчитываются только корзины с нее; испорченные раньше остаются
+    conn.execute("UPDATE rollups_daily SET completions = 7 WHERE user_id = 0 AND bucket = '2024-01-01'")
+    backfill_rollups(conn, '2024-01-02 00:00:00')
+    assert [mismatch[:3] for mismatch in reconcile_rollups(conn)] == [('rollups_daily', '2024-01-01', task_id)]
+    backfill_rollups(conn)
+    assert rollups(conn) == from_triggers
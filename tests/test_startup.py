@@ -0,0 +1,18 @@
+import os
+
+import bench
+
+
+def test_time_to_first_response_within_budget(tmp_path):
+    db_path = str(tmp_path / "tasks.db")
+    bench.seed_database(db_path, users=1000, assignments=10000)
+    args = bench.parse_args(["--cold-start", "--cold-start-runs", "3"])
+    env = dict(os.environ, TASKS_DB_PATH=db_path, DATABASE_URL=f"sqlite:///{db_path}",
+               DB_SHARDS="1", WEB_CONCURRENCY="1")
+
+    result = bench.cold_start(args, env)
+
+    assert result["time_to_first_response_ms"]["median"] <= args.startup_budget_ms
+    # Профиль старта покрывает все фазы до первого ответа
+    for phase in ("imports", "prepare_database", "first_request"):
+        assert phase in result["profile"]
@@ -0,0 +1,52 @@
+import sqlite3
+
+import repository
+from task_cache import TemplateCache
+
+
+def traced(conn) -> list:
+    statements = []
+    conn.set_trace_callback(statements.append)
+    return statements
+
+
+def add_task(db_path, reward=1.0):
+    other = sqlite3.connect(db_path)
+    repository.insert_task(other, ("https://example.com/{keyword}", "t", "d", 10, 20, 30, 40, reward))
+    other.commit()
+    other.close()
+
+
+def test_ensure_skips_version_check_within_interval(conn):
+    cache = TemplateCache(revalidate_interval=60)
+    cache.ensure(conn)
+    loaded = len(cache.templates)
+
+    statements = traced(conn)
+    for _ in range(100):
+        cache.ensure(conn)
+    assert statements == []
+    assert len(cache.templates) == loaded
+
+
+def test_ensure_sees_other_writers_after_interval(conn, db_path):
+    cache = TemplateCache(revalidate_interval=0)
+    cache.ensure(conn)
+    loaded = len(cache.templates)
+
+    add_task(db_path)
+    cache.ensure(conn)
+    assert len(cache.templates) == loaded + 1
+
+
+def test_invalidate_reloads_immediately(conn, db_path):
+    cache = TemplateCache(revalidate_interval=60)
+    cache.ensure(conn)
+    loaded = len(cache.templates)
+
+    add_task(db_path)
+    cache.ensure(conn)
+    assert len(cache.templates) == loaded
+    cache.invalidate()
+    cache.ensure(conn)
+    assert len(cache.templates) == loaded + 1
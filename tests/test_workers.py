@@ -0,0 +1,44 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import bench
+
+
+def complete_one(client, device_id):
+    assignment = client.get(f"/get-task/{device_id}").json()
+    response = client.post("/complete-task", json={"device_id": device_id,
+                                                   "assignment_id": assignment["assignment_id"]})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_app_survives_repeated_lifespans(app, db_path):
+    """Шарды и писатели открываются в lifespan, а не при импорте"""
+    for expected in (1, 2):
+        with TestClient(app) as client:
+            complete_one(client, "dev-1")
+            assert client.get("/user/dev-1").json()["total_completed"] == expected
+    assert bench.check_consistency(db_path) == []
+
+
+@pytest.mark.parametrize("shards", [1, 2])
+def test_workers_keep_data_consistent(tmp_path, shards):
+    """Несколько процессов uvicorn пишут в одни файлы, счетчики сходятся со строками"""
+    db_path = str(tmp_path / "tasks.db")
+    bench.seed_database(db_path, users=200, assignments=2000, shards=shards)
+    args = bench.parse_args(["--workers", "2", "--shards", str(shards), "--duration", "2",
+                             "--devices", "100", "--concurrency", "8", "--admin-interval", "0.2"])
+    env = dict(os.environ, TASKS_DB_PATH=db_path, DB_SHARDS=str(shards),
+               DATABASE_URL=f"sqlite:///{db_path}", WEB_CONCURRENCY="2",
+               RATE_LIMIT_IP_RPS="0", RATE_LIMIT_DEVICE_RPS="0",
+               SHED_MAX_PENDING_WRITES="0", SHED_MAX_LOOP_LAG_MS="0")
+
+    result = asyncio.run(bench.run_uvicorn(args, env))
+
+    completed = result["endpoints"]["POST /complete-task"]
+    assert completed["requests"] > 0
+    assert completed["errors"] == 0
+    assert bench.check_shards(db_path, shards) == []